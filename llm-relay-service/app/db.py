@@ -1,11 +1,24 @@
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 from .settings import settings
 
 engine = create_engine(settings.database_url, future=True, pool_pre_ping=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+# Увеличивать при изменении DDL ниже: при совпадении версии старт воркера — один SELECT
+SCHEMA_VERSION = 1
+
+def _schema_version() -> int:
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except DBAPIError:
+        return 0
+
 def init_db():
+    if _schema_version() == SCHEMA_VERSION:
+        return
     with engine.begin() as conn:
         conn.execute(text("""
         CREATE TABLE IF NOT EXISTS jobs (
@@ -19,3 +32,6 @@ def init_db():
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         );
         """))
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL);"))
+        conn.execute(text("DELETE FROM schema_version"))
+        conn.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {"v": SCHEMA_VERSION})
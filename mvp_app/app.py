@@ -1,16 +1,18 @@
 from __future__ import annotations
 import streamlit as st
-from config import APP_TITLE, AI_API_BASE, AI_API_KEY, PDF_DPI_DEFAULT, PDF_DPI_MIN, PDF_DPI_MAX
-from ui.state import init_session_state, soft_refresh_jobs_and_results, auto_refresh_if_active
-from ui.sections import add_task_ui, delete_confirmation_widget, submission_form, ai_and_teacher_blocks
+from config import APP_TITLE, AI_API_BASE, AI_API_KEY, PDF_DPI_DEFAULT, PDF_DPI_MIN, PDF_DPI_MAX, TASKS_PAGE_SIZE
+from repository import count_tasks, list_tasks
+from ui.state import init_session_state, auto_refresh_if_active
+from ui.sections import add_task_ui, delete_confirmation_widget, paginator, task_submissions_section, analytics_section
 from services.webhook_server import start_once as start_webhook
+from services.dispatcher import start_once as start_dispatcher
 
 st.set_page_config(page_title=APP_TITLE, layout="wide")
 st.title(APP_TITLE)
 
 start_webhook()
 init_session_state()
-soft_refresh_jobs_and_results()
+start_dispatcher()
 auto_refresh_if_active()
 
 with st.sidebar:
@@ -19,6 +21,9 @@ with st.sidebar:
     api_key = st.text_input("API key", value=AI_API_KEY, type="password")
     dpi = st.slider("DPI рендера (PDF)", PDF_DPI_MIN, PDF_DPI_MAX, PDF_DPI_DEFAULT)
 
+if st.toggle("Аналитика: AI и преподаватель", key="show_analytics"):
+    analytics_section()
+
 st.subheader("Задания")
 c_add, _ = st.columns([1, 6])
 with c_add:
@@ -28,10 +33,12 @@ with c_add:
 if st.session_state.show_create:
     add_task_ui()
 
-if not st.session_state.tasks:
+total_tasks = count_tasks()
+if not total_tasks:
     st.caption("Пока нет заданий — создайте первое.")
 
-for task in st.session_state.tasks:
+page = paginator(total_tasks, TASKS_PAGE_SIZE, key="tasks_page")
+for task in (t.__dict__ for t in list_tasks(TASKS_PAGE_SIZE, (page - 1) * TASKS_PAGE_SIZE)):
     with st.container(border=True):
         head_l, head_r = st.columns([0.88, 0.12])
         with head_l:
@@ -43,8 +50,8 @@ for task in st.session_state.tasks:
         if st.session_state.get("confirm_delete_task") == task["id"]:
             delete_confirmation_widget(task["id"])
 
-        with st.expander("Ответ ученика и оценки", expanded=not bool(st.session_state.submissions.get(task["id"]))):
-            submission_form(task, dpi=dpi)
-            ai_and_teacher_blocks(task)
+        # Вместо st.expander: содержимое строится и читает БД, только когда раздел открыт
+        if st.toggle("Решения студентов и оценки", key=f"open_{task['id']}"):
+            task_submissions_section(task, dpi=dpi)
 
     st.divider()
@@ -0,0 +1,104 @@
+"""Профиль импорта при холодном старте приложения (`python -X importtime`).
+
+    python benchmarks/importtime.py [--top 15] [--repeat 3] [--json report.json] [--modules a,b]
+
+Импортирует модули, которые app.py загружает до первого рендера, в чистом процессе
+и печатает самые дорогие импорты. Бюджет в importtime_budget.json: список тяжёлых
+модулей, которые не должны загружаться при старте, и max_total_ms. Замер, по которому
+выставлен max_total_ms, лежит в importtime_baseline.json (обновлять через --json).
+Код выхода 1 — бюджет нарушен, 2 — модули не импортируются.
+"""
+from __future__ import annotations
+import argparse, json, os, re, subprocess, sys
+from typing import Dict, List, Optional, Tuple
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "importtime_budget.json")
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S+)$")
+
+def profile(modules: List[str]) -> List[Tuple[str, int, int, int]]:
+    """[(модуль, self_us, cumulative_us, уровень вложенности)] для одного холодного запуска."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + ", ".join(modules)],
+        cwd=APP_DIR, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    rows = []
+    for line in proc.stderr.splitlines():
+        m = _LINE_RE.match(line)
+        if m:
+            rows.append((m.group(4), int(m.group(1)), int(m.group(2)), (len(m.group(3)) - 1) // 2))
+    return rows
+
+def summarize(runs: List[List[Tuple[str, int, int, int]]]) -> Dict[str, object]:
+    # Минимум по запускам: меньше всего зависит от шума соседних процессов
+    best = min(runs, key=lambda rows: sum(r[2] for r in rows if r[3] == 0))
+    cumulative: Dict[str, int] = {}
+    for name, _self_us, cum_us, _level in best:
+        cumulative[name] = max(cumulative.get(name, 0), cum_us)
+    return {
+        "total_ms": round(sum(r[2] for r in best if r[3] == 0) / 1000, 1),
+        "loaded": sorted(cumulative),
+        "top": sorted(({"module": k, "cumulative_ms": round(v / 1000, 1)} for k, v in cumulative.items()),
+                      key=lambda r: r["cumulative_ms"], reverse=True),
+    }
+
+def versions(modules: List[str]) -> Dict[str, str]:
+    """Версии Python и сторонних пакетов из списка модулей: без них замер не с чем сравнивать."""
+    from importlib import metadata
+    found = {"python": sys.version.split()[0]}
+    for top in sorted({m.split(".")[0] for m in modules}):
+        if os.path.exists(os.path.join(APP_DIR, top)) or os.path.exists(os.path.join(APP_DIR, top + ".py")):
+            continue
+        try:
+            found[top] = metadata.version(top)
+        except metadata.PackageNotFoundError:
+            pass
+    return found
+
+def check(report: Dict[str, object], budget: Dict[str, object]) -> List[str]:
+    problems = []
+    loaded = report["loaded"]
+    for mod in budget.get("forbidden", []):
+        hits = [name for name in loaded if name == mod or name.startswith(mod + ".")]
+        if hits:
+            problems.append(f"{mod} загружается при старте ({len(hits)} модулей)")
+    max_total = budget.get("max_total_ms")
+    if max_total is not None and report["total_ms"] > max_total:
+        problems.append(f"время импорта {report['total_ms']} мс > бюджета {max_total} мс")
+    return problems
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Профиль импорта при холодном старте.")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    parser.add_argument("--modules", help="модули через запятую вместо списка из бюджета")
+    args = parser.parse_args(argv)
+
+    with open(BUDGET_PATH, encoding="utf-8") as f:
+        budget = json.load(f)
+    modules = args.modules.split(",") if args.modules else budget["modules"]
+    try:
+        report = summarize([profile(modules) for _ in range(max(1, args.repeat))])
+    except RuntimeError as e:
+        print(f"Не удалось импортировать {', '.join(modules)}: {e}", file=sys.stderr)
+        return 2
+    report["modules"] = modules
+    report["versions"] = versions(modules)
+
+    print(f"Импорт {', '.join(modules)}: {report['total_ms']} мс")
+    for row in report["top"][:args.top]:
+        print(f"  {row['cumulative_ms']:>8.1f} мс  {row['module']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    problems = check(report, budget)
+    for p in problems:
+        print(f"БЮДЖЕТ: {p}", file=sys.stderr)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,3 +16,34 @@ WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8008"))
 
 PDF_DPI_DEFAULT = 150
 PDF_DPI_MIN, PDF_DPI_MAX = 72, 220
+
+PAGES_DIR = os.getenv("APP_PAGES_DIR", UPLOAD_DIR.rstrip("/\\") + "_pages")
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "0")) or (os.cpu_count() or 1)
+THUMB_MAX_SIDE = 320
+PAGE_IMAGE_FORMAT = os.getenv("PAGE_IMAGE_FORMAT", "WEBP")
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600
+# Загруженные, но так и не отправленные файлы (refs=0) удаляются через столько часов
+UPLOAD_ORPHAN_MAX_AGE = float(os.getenv("UPLOAD_ORPHAN_MAX_AGE_HOURS", "24")) * 3600
+
+# Должен совпадать с CALLBACK_HMAC_SECRET relay; пока не задан, колбэки отклоняются
+CALLBACK_HMAC_SECRET = os.getenv("CALLBACK_HMAC_SECRET", "")
+WEBHOOK_THREADS = int(os.getenv("WEBHOOK_THREADS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "200"))
+WEBHOOK_BATCH_WAIT = float(os.getenv("WEBHOOK_BATCH_WAIT", "0.05"))
+
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", "5"))
+DISPATCH_BACKOFF_SECONDS = float(os.getenv("DISPATCH_BACKOFF_SECONDS", "2"))
+DISPATCH_POOL_SIZE = int(os.getenv("DISPATCH_POOL_SIZE", "8"))
+
+TASKS_PAGE_SIZE = int(os.getenv("TASKS_PAGE_SIZE", "20"))
+SUBMISSIONS_PAGE_SIZE = int(os.getenv("SUBMISSIONS_PAGE_SIZE", "50"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "100"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "8"))
+
+LLM_IMAGE_MAX_SIDE = int(os.getenv("LLM_IMAGE_MAX_SIDE", "1600"))
+# Доля пикселей темнее фона (на странице до 2000px), ниже которой страница считается пустой
+BLANK_PAGE_INK_RATIO = float(os.getenv("BLANK_PAGE_INK_RATIO", "0.0005"))
+PREPROCESS_TIMEOUT = float(os.getenv("PREPROCESS_TIMEOUT", "120"))
@@ -4,50 +4,168 @@ from contextlib import closing
 from config import DB_PATH, UPLOAD_DIR
 import os
 
+# Увеличивать при любом изменении _SCHEMA: при совпадении версии migrate() не выполняет DDL.
+SCHEMA_VERSION = 2
+# Версия, в которой появились агрегаты согласия AI/преподавателя (agreement_stats)
+_AGREEMENT_STATS_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks(
+    id TEXT PRIMARY KEY,
+    condition TEXT NOT NULL,
+    created INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks(created);
+CREATE TABLE IF NOT EXISTS submissions(
+    id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    student_id TEXT NOT NULL,
+    student_name TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    mode TEXT NOT NULL CHECK(mode IN ('file','text')),
+    text TEXT,
+    file_path TEXT,
+    file_name TEXT,
+    uploaded_at INTEGER NOT NULL,
+    UNIQUE(task_id, student_id),
+    FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_task_status ON submissions(task_id, status, uploaded_at);
+CREATE TABLE IF NOT EXISTS results(
+    submission_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    json TEXT NOT NULL,
+    updated INTEGER NOT NULL,
+    FOREIGN KEY(submission_id) REFERENCES submissions(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS teacher_reviews(
+    submission_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    json TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    FOREIGN KEY(submission_id) REFERENCES submissions(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS review_jobs(
+    submission_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    external_id TEXT,
+    result_json TEXT,
+    created INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_review_jobs_status ON review_jobs(status);
+CREATE TABLE IF NOT EXISTS dispatch_queue(
+    submission_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL CHECK(state IN ('pending','failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt INTEGER NOT NULL,
+    last_error TEXT,
+    created INTEGER NOT NULL,
+    FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_dispatch_due ON dispatch_queue(state, next_attempt);
+CREATE TABLE IF NOT EXISTS agreement_pairs(
+    submission_id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    json TEXT NOT NULL,
+    FOREIGN KEY(submission_id) REFERENCES submissions(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS agreement_stats(
+    task_id TEXT NOT NULL,
+    criterion TEXT NOT NULL,
+    n00 INTEGER NOT NULL DEFAULT 0,
+    n01 INTEGER NOT NULL DEFAULT 0,
+    n10 INTEGER NOT NULL DEFAULT 0,
+    n11 INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(task_id, criterion),
+    FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS score_delta_stats(
+    task_id TEXT PRIMARY KEY,
+    n INTEGER NOT NULL DEFAULT 0,
+    sum_delta REAL NOT NULL DEFAULT 0,
+    sum_sq_delta REAL NOT NULL DEFAULT 0,
+    sum_abs_delta REAL NOT NULL DEFAULT 0,
+    FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS blobs(
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0,
+    created INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS schema_version(
+    version INTEGER NOT NULL
+);
+"""
+
+# Старая схема: одно решение на задание, submissions/results/teacher_reviews с ключом task_id.
+# Решения переносятся с id вида "{task_id}-submission", как их называл прежний UI.
+_LEGACY_SUBMISSIONS_MIGRATION = """
+ALTER TABLE submissions RENAME TO submissions_v1;
+ALTER TABLE results RENAME TO results_v1;
+ALTER TABLE teacher_reviews RENAME TO teacher_reviews_v1;
+""" + _SCHEMA + """
+INSERT INTO submissions(id, task_id, student_id, student_name, status, mode, text, file_path, file_name, uploaded_at)
+SELECT s.task_id || '-submission', s.task_id, '', NULL, COALESCE(j.status, 'done'),
+       s.mode, s.text, s.file_path, s.file_name, s.uploaded_at
+FROM submissions_v1 s
+LEFT JOIN review_jobs j ON j.submission_id = s.task_id || '-submission';
+INSERT INTO results(submission_id, task_id, json, updated)
+SELECT task_id || '-submission', task_id, json, updated FROM results_v1
+WHERE task_id || '-submission' IN (SELECT id FROM submissions);
+INSERT INTO teacher_reviews(submission_id, task_id, json, total, updated)
+SELECT task_id || '-submission', task_id, json, total, updated FROM teacher_reviews_v1
+WHERE task_id || '-submission' IN (SELECT id FROM submissions);
+DROP TABLE teacher_reviews_v1;
+DROP TABLE results_v1;
+DROP TABLE submissions_v1;
+"""
+
 def connect() -> sqlite3.Connection:
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.execute("PRAGMA foreign_keys = ON")
     return conn
 
+def _columns(conn: sqlite3.Connection, table: str) -> list:
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    try:
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] or 0
+
+_migrated = False
+
 def migrate() -> None:
+    global _migrated
+    if _migrated:
+        return
     os.makedirs(UPLOAD_DIR, exist_ok=True)
     with closing(connect()) as conn, conn:
-        conn.executescript("""
-        CREATE TABLE IF NOT EXISTS tasks(
-            id TEXT PRIMARY KEY,
-            condition TEXT NOT NULL,
-            created INTEGER NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS results(
-            task_id TEXT PRIMARY KEY,
-            json TEXT NOT NULL,
-            updated INTEGER NOT NULL,
-            FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
-        );
-        CREATE TABLE IF NOT EXISTS submissions(
-            task_id TEXT PRIMARY KEY,
-            mode TEXT NOT NULL CHECK(mode IN ('file','text')),
-            text TEXT,
-            file_path TEXT,
-            file_name TEXT,
-            uploaded_at INTEGER NOT NULL,
-            FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
-        );
-        CREATE TABLE IF NOT EXISTS teacher_reviews(
-            task_id TEXT PRIMARY KEY,
-            json TEXT NOT NULL,
-            total INTEGER NOT NULL,
-            updated INTEGER NOT NULL,
-            FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
-        );
-        CREATE TABLE IF NOT EXISTS review_jobs(
-            submission_id TEXT PRIMARY KEY,
-            task_id TEXT NOT NULL,
-            status TEXT NOT NULL,
-            external_id TEXT,
-            result_json TEXT,
-            created INTEGER NOT NULL,
-            updated INTEGER NOT NULL,
-            FOREIGN KEY(task_id) REFERENCES tasks(id) ON DELETE CASCADE
-        );
-        """)
+        stored = _schema_version(conn)
+        if stored == SCHEMA_VERSION:
+            _migrated = True
+            return
+        # WAL: чтение из UI не блокируется записью колбэков
+        conn.execute("PRAGMA journal_mode=WAL")
+        cols = _columns(conn, "submissions")
+        if cols and "id" not in cols:
+            conn.executescript("BEGIN;" + _LEGACY_SUBMISSIONS_MIGRATION + "COMMIT;")
+        conn.executescript(_SCHEMA)
+        conn.execute("BEGIN IMMEDIATE")
+        if stored < _AGREEMENT_STATS_VERSION:
+            # Дальше агрегаты ведутся инкрементально, поэтому уже оценённые пары (в том числе
+            # перенесённые из старой схемы) учитываются один раз — в одной транзакции с версией
+            from services import analytics
+            analytics.rebuild(conn)
+        conn.execute("DELETE FROM schema_version")
+        conn.execute("INSERT INTO schema_version(version) VALUES(?)", (SCHEMA_VERSION,))
+    _migrated = True
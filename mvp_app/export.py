@@ -0,0 +1,60 @@
+"""Выгрузки из базы приложения.
+
+    python export.py gradebook --task T0001 --out grades.csv     # или --out - (stdout)
+    python export.py gradebook --out grades.xlsx [--task T0001]  # XLSX: лист на задание
+    python export.py agreement [--task T0001] [--rebuild]
+
+gradebook — журнал оценок в формате листа оценивания Moodle, пишется потоково.
+Moodle принимает лист оценивания в одно задание, поэтому для CSV --task обязателен.
+agreement — согласие AI и преподавателя по критериям (каппа Коэна) и разница итоговых оценок.
+"""
+from __future__ import annotations
+import argparse, sys
+from typing import List, Optional
+from db import migrate
+
+def _gradebook(args: argparse.Namespace) -> int:
+    from services import gradebook
+    if args.out == "-":
+        rows = gradebook.write_csv(sys.stdout, args.task)
+    elif args.out.lower().endswith(".xlsx"):
+        rows = gradebook.write_xlsx(args.out, args.task)
+    else:
+        # utf-8-sig: Excel и импорт Moodle корректно распознают кириллицу
+        with open(args.out, "w", newline="", encoding="utf-8-sig") as out:
+            rows = gradebook.write_csv(out, args.task)
+    print(f"Строк: {rows}", file=sys.stderr)
+    return 0
+
+def _agreement(args: argparse.Namespace) -> int:
+    from services import analytics
+    if args.rebuild:
+        analytics.rebuild()
+    agreement = analytics.load_agreement(args.task)
+    deltas = analytics.load_score_deltas(args.task)
+    print(agreement.to_string() if not agreement.empty else "Нет пар оценок AI/преподаватель.")
+    if not deltas.empty:
+        print()
+        print(deltas.to_string())
+    return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Выгрузки оценок и аналитики.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_grades = sub.add_parser("gradebook", help="журнал оценок для Moodle (CSV/XLSX)")
+    p_grades.add_argument("--out", required=True, help="путь к .csv/.xlsx или - для stdout")
+    p_grades.add_argument("--task", help="только одно задание")
+    p_grades.set_defaults(func=_gradebook)
+    p_agree = sub.add_parser("agreement", help="согласие AI и преподавателя")
+    p_agree.add_argument("--task", help="только одно задание")
+    p_agree.add_argument("--rebuild", action="store_true", help="пересчитать агрегаты с нуля")
+    p_agree.set_defaults(func=_agreement)
+    args = parser.parse_args(argv)
+    if args.command == "gradebook" and not args.task and not args.out.lower().endswith(".xlsx"):
+        parser.error("для CSV укажите --task: Moodle загружает лист оценивания в одно задание "
+                     "(для всех заданий сразу используйте .xlsx — лист на задание)")
+    migrate()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""Массовая загрузка решений из выгрузки задания Moodle.
+
+    python ingest.py export.zip --task T0001 [--concurrency 8] [--batch-size 100] [--no-dispatch]
+
+Выгрузка «Скачать все ответы» — ZIP с папкой на студента вида
+«Иван Петров_123456_assignsubmission_file_». Файлы читаются из архива потоково,
+сохраняются в хранилище загрузок (несколько файлов студента — например, фото страниц —
+склеиваются в один PDF), решения и задания на проверку создаются пачками,
+после чего очередь отправляется в relay. Повторный запуск пропускает уже загруженных
+студентов и досылает то, что осталось в очереди, поэтому прерванный запуск можно продолжить.
+"""
+from __future__ import annotations
+import argparse, html, os, re, sys, tempfile, time, zipfile
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from config import INGEST_BATCH_SIZE, INGEST_CONCURRENCY, UPLOAD_DIR, UPLOAD_ORPHAN_MAX_AGE
+from db import migrate
+from models import Submission
+from repository import get_task, submission_ids, make_submission_id, create_submissions
+from services import dispatcher, upload_store
+from services.pdf_renderer import merge_to_pdf
+
+FILE_EXTS = (".pdf", ".png", ".jpg", ".jpeg")
+_FOLDER_RE = re.compile(r"^(?P<name>.+?)_(?P<pid>\d+)_assignsubmission_(?P<plugin>[a-z]+)_?$")
+
+def _parse_folder(folder: str) -> Tuple[str, str]:
+    """(student_id, student_name) по имени папки студента."""
+    m = _FOLDER_RE.match(folder)
+    if m:
+        return m.group("pid"), m.group("name")
+    return folder, folder
+
+def _html_to_text(raw: bytes) -> str:
+    text = re.sub(r"<(br|/p|/div|/li)\s*/?>", "\n", raw.decode("utf-8", "replace"), flags=re.I)
+    return html.unescape(re.sub(r"<[^>]+>", "", text)).strip()
+
+def iter_students(zf: zipfile.ZipFile) -> Iterator[Tuple[str, str, List[zipfile.ZipInfo]]]:
+    # Читается только оглавление архива; содержимое открывается по одному файлу
+    groups: "OrderedDict[Tuple[str, str], List[zipfile.ZipInfo]]" = OrderedDict()
+    for info in zf.infolist():
+        if info.is_dir() or "/" not in info.filename:
+            continue
+        student_id, student_name = _parse_folder(info.filename.split("/", 1)[0])
+        groups.setdefault((student_id, student_name), []).append(info)
+    for (student_id, student_name), infos in groups.items():
+        yield student_id, student_name, sorted(infos, key=lambda i: i.filename)
+
+def _pick_entry(infos: List[zipfile.ZipInfo]) -> Tuple[List[zipfile.ZipInfo], Optional[zipfile.ZipInfo]]:
+    files = [i for i in infos if i.filename.lower().endswith(FILE_EXTS)]
+    texts = [i for i in infos if i.filename.lower().endswith((".html", ".htm"))]
+    return files, (texts[0] if texts else None)
+
+def _store_files(zf: zipfile.ZipFile, files: List[zipfile.ZipInfo]) -> Tuple[str, str, int]:
+    """Сохраняет файлы студента одним блобом: (имя блоба, имя файла, сколько файлов пропущено)."""
+    first_name = os.path.basename(files[0].filename)
+    if len(files) > 1:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            merged = os.path.join(tmp_dir, "merged.pdf")
+            if merge_to_pdf(((i.filename, zf.read(i)) for i in files), merged):
+                with open(merged, "rb") as fh:
+                    blob_name = upload_store.store(fh, merged)
+                return blob_name, f"{os.path.splitext(first_name)[0]} (+{len(files) - 1}).pdf", 0
+    # Один файл или нет PyMuPDF для склейки: берётся первый, остальные учитываются как пропущенные
+    with zf.open(files[0]) as fh:
+        return upload_store.store(fh, files[0].filename), first_name, len(files) - 1
+
+class Progress:
+    def __init__(self, total: int, label: str):
+        self.total, self.label = total, label
+        self.done = self.skipped = self.failed = self.bytes = 0
+        self.merged_files = self.dropped_files = 0
+        self.started = self._last = time.monotonic()
+
+    def tick(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last < 1.0:
+            return
+        self._last = now
+        elapsed = max(now - self.started, 1e-6)
+        files = (f" · склеено файлов {self.merged_files}" if self.merged_files else "") + \
+                (f" · файлов не загружено {self.dropped_files}" if self.dropped_files else "")
+        print(
+            f"\r{self.label}: {self.done + self.skipped + self.failed}/{self.total}"
+            f" (новых {self.done}, пропущено {self.skipped}, ошибок {self.failed}){files}"
+            f" · {self.done / elapsed:.1f}/с · {self.bytes / elapsed / 1e6:.1f} МБ/с",
+            end="", file=sys.stderr, flush=True,
+        )
+
+def ingest(zip_path: str, task: Dict[str, Any], batch_size: int) -> None:
+    existing = submission_ids(task["id"])
+    batch: List[Tuple[Submission, Dict[str, Any]]] = []
+    with zipfile.ZipFile(zip_path) as zf:
+        students = list(iter_students(zf))
+        progress = Progress(len(students), "Загрузка")
+        for student_id, student_name, infos in students:
+            submission_id = make_submission_id(task["id"], student_id)
+            if submission_id in existing:
+                progress.skipped += 1
+                progress.tick()
+                continue
+            files, text_info = _pick_entry(infos)
+            try:
+                if files:
+                    blob_name, file_name, dropped = _store_files(zf, files)
+                    sub = Submission(submission_id, task["id"], student_id, student_name, "queued",
+                                     "file", None, os.path.join(UPLOAD_DIR, blob_name),
+                                     file_name, int(time.time()))
+                    progress.bytes += sum(i.file_size for i in files)
+                    if dropped:
+                        progress.dropped_files += dropped
+                        print(f"\n{student_name}: загружен только {file_name}, ещё {dropped} файл(ов) "
+                              f"не склеены — установите PyMuPDF", file=sys.stderr)
+                    elif len(files) > 1:
+                        progress.merged_files += len(files)
+                elif text_info is not None:
+                    with zf.open(text_info) as fh:
+                        text = _html_to_text(fh.read())
+                    sub = Submission(submission_id, task["id"], student_id, student_name, "queued",
+                                     "text", text, None, None, int(time.time()))
+                    progress.bytes += text_info.file_size
+                else:
+                    progress.skipped += 1
+                    progress.tick()
+                    continue
+            except (OSError, RuntimeError, ValueError, zipfile.BadZipFile) as e:
+                # RuntimeError/ValueError — битый PDF или фото при склейке
+                progress.failed += 1
+                print(f"\n{student_name}: {e}", file=sys.stderr)
+                continue
+            batch.append((sub, dispatcher.build_payload(task, sub)))
+            if len(batch) >= batch_size:
+                progress.done += create_submissions(batch)
+                batch = []
+            progress.tick()
+        if batch:
+            progress.done += create_submissions(batch)
+        progress.tick(force=True)
+        print(file=sys.stderr)
+
+def dispatch(concurrency: int) -> None:
+    progress = Progress(0, "Отправка")
+
+    def on_result(_item: Dict[str, Any], ok: bool) -> None:
+        progress.total += 1
+        if ok:
+            progress.done += 1
+        else:
+            progress.failed += 1
+        progress.tick()
+
+    dispatcher.drain(concurrency, on_result)
+    progress.tick(force=True)
+    print(file=sys.stderr)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Загрузка выгрузки решений Moodle (ZIP) в задание.")
+    parser.add_argument("zip_path", help="ZIP «Скачать все ответы» из задания Moodle")
+    parser.add_argument("--task", required=True, help="ID задания, например T0001")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=INGEST_CONCURRENCY)
+    parser.add_argument("--no-dispatch", action="store_true", help="только загрузить, не отправлять в relay")
+    args = parser.parse_args(argv)
+
+    migrate()
+    task = get_task(args.task)
+    if task is None:
+        parser.error(f"задание {args.task} не найдено")
+    # Файлы прошлого прерванного импорта, не попавшие в базу
+    upload_store.sweep_orphans(UPLOAD_ORPHAN_MAX_AGE)
+    ingest(args.zip_path, task.__dict__, max(1, args.batch_size))
+    if not args.no_dispatch:
+        dispatch(max(1, args.concurrency))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
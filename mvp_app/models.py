@@ -10,7 +10,11 @@ class Task:
 
 @dataclass
 class Submission:
+    id: str
     task_id: str
+    student_id: str
+    student_name: Optional[str]
+    status: str          # queued|processing|done|error (повторяет статус ReviewJob)
     mode: str            # 'file' | 'text'
     text: Optional[str]
     file_path: Optional[str]
@@ -1,9 +1,10 @@
 from __future__ import annotations
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 from contextlib import closing
-import json, time
+import json, os, re, sqlite3, time
 from db import connect
-from models import Task, Submission, ReviewJob
+from models import Task, Submission
+from services import upload_store
 
 def upsert_task(task: Task) -> None:
     with closing(connect()) as conn, conn:
@@ -14,119 +15,372 @@ def upsert_task(task: Task) -> None:
 
 def delete_task(task_id: str) -> None:
     with closing(connect()) as conn, conn:
+        cur = conn.execute(
+            "SELECT file_path FROM submissions WHERE task_id=? AND file_path IS NOT NULL", (task_id,)
+        )
+        for (file_path,) in cur.fetchall():
+            upload_store.release(conn, os.path.basename(file_path))
         conn.execute("DELETE FROM tasks WHERE id=?", (task_id,))
 
-def list_tasks() -> List[Task]:
+def list_tasks(limit: Optional[int] = None, offset: int = 0) -> List[Task]:
     with closing(connect()) as conn:
-        cur = conn.execute("SELECT id, condition, created FROM tasks ORDER BY created ASC")
+        cur = conn.execute(
+            "SELECT id, condition, created FROM tasks ORDER BY created ASC, id ASC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset),
+        )
         return [Task(*row) for row in cur.fetchall()]
 
-def upsert_result(task_id: str, data: Dict[str, Any]) -> None:
-    with closing(connect()) as conn, conn:
-        conn.execute(
-            "INSERT OR REPLACE INTO results(task_id, json, updated) VALUES(?,?,?)",
-            (task_id, json.dumps(data, ensure_ascii=False), int(time.time())),
-        )
+def count_tasks() -> int:
+    with closing(connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
 
-def load_results() -> Dict[str, Dict[str, Any]]:
+def max_task_number() -> int:
     with closing(connect()) as conn:
-        cur = conn.execute("SELECT task_id, json FROM results")
-        return {r[0]: json.loads(r[1]) for r in cur.fetchall()}
+        cur = conn.execute("SELECT id FROM tasks WHERE id LIKE 'T%'")
+        return max((int(r[0][1:]) for r in cur.fetchall() if r[0][1:].isdigit()), default=0)
+
+def get_task(task_id: str) -> Optional[Task]:
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT id, condition, created FROM tasks WHERE id=?", (task_id,)).fetchone()
+        return Task(*row) if row else None
+
+def make_submission_id(task_id: str, student_id: str) -> str:
+    return f"{task_id}-" + re.sub(r"[^\w.@-]+", "_", student_id.strip())
 
-def upsert_submission(sub: Submission) -> None:
+def _sync_submission_status(conn, submission_ids: List[str]) -> None:
+    # submissions.status повторяет review_jobs.status, чтобы фильтр по статусу шёл по индексу
+    conn.executemany(
+        """
+        UPDATE submissions SET status=(SELECT status FROM review_jobs WHERE submission_id=?)
+        WHERE id=? AND EXISTS(SELECT 1 FROM review_jobs WHERE submission_id=?)
+        """,
+        [(sid, sid, sid) for sid in submission_ids],
+    )
+
+def load_result(submission_id: str) -> Optional[Dict[str, Any]]:
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT json FROM results WHERE submission_id=?", (submission_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+_SUBMISSION_COLUMNS = "id, task_id, student_id, student_name, status, mode, text, file_path, file_name, uploaded_at"
+
+def _submission_values(sub: Submission) -> Tuple:
+    return (sub.id, sub.task_id, sub.student_id, sub.student_name, sub.status, sub.mode,
+            sub.text, sub.file_path, sub.file_name, sub.uploaded_at)
+
+def create_submissions(entries: List[Tuple[Submission, Dict[str, Any]]]) -> int:
+    """Пакетная вставка решений вместе с queued-заданием и записью в очереди отправки.
+
+    Уже существующие решения пропускаются; возвращает число добавленных.
+    """
+    now = int(time.time())
+    created = 0
     with closing(connect()) as conn, conn:
-        conn.execute(
-            """
-            INSERT OR REPLACE INTO submissions(task_id, mode, text, file_path, file_name, uploaded_at)
-            VALUES(?,?,?,?,?,?)
-            """,
-            (sub.task_id, sub.mode, sub.text, sub.file_path, sub.file_name, sub.uploaded_at),
+        for sub, payload in entries:
+            cur = conn.execute(
+                f"INSERT OR IGNORE INTO submissions({_SUBMISSION_COLUMNS}) VALUES(?,?,?,?,?,?,?,?,?,?)",
+                _submission_values(sub),
+            )
+            if cur.rowcount == 0:
+                continue
+            created += 1
+            if sub.file_path:
+                upload_store.acquire(conn, os.path.basename(sub.file_path))
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO review_jobs(submission_id, task_id, status, external_id, result_json, created, updated)
+                VALUES(?,?,'queued',NULL,NULL,?,?)
+                """,
+                (sub.id, sub.task_id, now, now),
+            )
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO dispatch_queue(submission_id, task_id, payload, state, attempts, next_attempt, last_error, created)
+                VALUES(?,?,?,'pending',0,?,NULL,?)
+                """,
+                (sub.id, sub.task_id, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+    return created
+
+def get_submission(submission_id: str) -> Optional[Submission]:
+    with closing(connect()) as conn:
+        row = conn.execute(
+            f"SELECT {_SUBMISSION_COLUMNS} FROM submissions WHERE id=?", (submission_id,)
+        ).fetchone()
+        return Submission(*row) if row else None
+
+def submission_ids(task_id: str) -> set:
+    with closing(connect()) as conn:
+        return {r[0] for r in conn.execute("SELECT id FROM submissions WHERE task_id=?", (task_id,))}
+
+def _status_clause(status: Optional[str]) -> Tuple[str, Tuple]:
+    return ("AND s.status=?", (status,)) if status else ("", ())
+
+def count_submissions(task_id: str, status: Optional[str] = None) -> int:
+    clause, args = _status_clause(status)
+    with closing(connect()) as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM submissions s WHERE s.task_id=? {clause}", (task_id, *args)
+        ).fetchone()[0]
+
+def submission_status_counts(task_id: str) -> Dict[str, int]:
+    with closing(connect()) as conn:
+        cur = conn.execute(
+            "SELECT status, COUNT(*) FROM submissions WHERE task_id=? GROUP BY status", (task_id,)
         )
+        return {r[0]: r[1] for r in cur.fetchall()}
 
-def load_submissions() -> Dict[str, Dict[str, Any]]:
+def list_submissions(task_id: str, limit: int, offset: int = 0,
+                     status: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Страница решений задания (новые сверху) с итогом преподавателя, без тяжёлых JSON."""
+    clause, args = _status_clause(status)
     with closing(connect()) as conn:
         cur = conn.execute(
-            "SELECT task_id, mode, text, file_path, file_name, uploaded_at FROM submissions"
+            f"""
+            SELECT s.id, s.student_id, s.student_name, s.status, s.mode, s.file_name, s.uploaded_at, t.total
+            FROM submissions s
+            LEFT JOIN teacher_reviews t ON t.submission_id = s.id
+            WHERE s.task_id=? {clause}
+            ORDER BY s.uploaded_at DESC, s.id
+            LIMIT ? OFFSET ?
+            """,
+            (task_id, *args, limit, offset),
         )
-        return {
-            r[0]: {
-                "mode": r[1],
-                "text": r[2],
-                "file_path": r[3],
-                "file_name": r[4],
-                "uploaded_at": r[5],
+        return [
+            {
+                "id": r[0],
+                "student_id": r[1],
+                "student_name": r[2],
+                "status": r[3],
+                "mode": r[4],
+                "file_name": r[5],
+                "uploaded_at": r[6],
+                "teacher_total": r[7],
             }
             for r in cur.fetchall()
-        }
+        ]
 
-def upsert_teacher_review(task_id: str, criteria_list: List[Dict[str, Any]]) -> int:
+def upsert_teacher_review(submission_id: str, task_id: str, criteria_list: List[Dict[str, Any]]) -> int:
+    from services import analytics
     total = min(sum(1 for c in criteria_list if bool(c.get("passed"))), 10)
     with closing(connect()) as conn, conn:
+        # IMMEDIATE: чтение старого вклада и запись агрегатов не пересекутся с пачкой колбэков
+        conn.execute("BEGIN IMMEDIATE")
         conn.execute(
             """
-            INSERT OR REPLACE INTO teacher_reviews(task_id, json, total, updated)
-            VALUES(?,?,?,?)
+            INSERT OR REPLACE INTO teacher_reviews(submission_id, task_id, json, total, updated)
+            VALUES(?,?,?,?,?)
             """,
-            (task_id, json.dumps(criteria_list, ensure_ascii=False), int(total), int(time.time())),
+            (submission_id, task_id, json.dumps(criteria_list, ensure_ascii=False), int(total), int(time.time())),
         )
+        analytics.record_reviews(conn, [submission_id])
     return total
 
-def load_teacher_reviews() -> Dict[str, Dict[str, Any]]:
+def load_teacher_review(submission_id: str) -> Optional[Dict[str, Any]]:
     with closing(connect()) as conn:
-        cur = conn.execute("SELECT task_id, json, total, updated FROM teacher_reviews")
-        return {
-            r[0]: {"criteria": json.loads(r[1]), "total": r[2], "updated": r[3]}
-            for r in cur.fetchall()
-        }
+        row = conn.execute(
+            "SELECT json, total, updated FROM teacher_reviews WHERE submission_id=?", (submission_id,)
+        ).fetchone()
+        return {"criteria": json.loads(row[0]), "total": row[1], "updated": row[2]} if row else None
+
+def iter_grade_rows(task_id: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Потоково отдаёт решения с результатами AI и оценками преподавателя (курсор, не список)."""
+    where, args = ("WHERE s.task_id=?", (task_id,)) if task_id else ("", ())
+    with closing(connect()) as conn:
+        cur = conn.execute(
+            f"""
+            SELECT s.id, s.task_id, s.student_id, s.student_name, s.status, s.uploaded_at,
+                   r.json, t.json, t.total, t.updated
+            FROM submissions s
+            LEFT JOIN results r ON r.submission_id = s.id
+            LEFT JOIN teacher_reviews t ON t.submission_id = s.id
+            {where}
+            ORDER BY s.task_id, s.student_id
+            """,
+            args,
+        )
+        for r in cur:
+            yield {
+                "submission_id": r[0],
+                "task_id": r[1],
+                "student_id": r[2],
+                "student_name": r[3],
+                "status": r[4],
+                "uploaded_at": r[5],
+                "result": json.loads(r[6]) if r[6] else None,
+                "teacher_criteria": json.loads(r[7]) if r[7] else None,
+                "teacher_total": r[8],
+                "teacher_updated": r[9],
+            }
+
+def iter_review_pairs(submission_ids: Optional[Iterable[str]] = None,
+                      conn: Optional[sqlite3.Connection] = None) -> Iterator[Tuple[str, str, Dict[str, Any], List[Dict[str, Any]], int]]:
+    """(submission_id, task_id, результат AI, критерии преподавателя, итог преподавателя) для проверенных решений.
 
-def upsert_review_job(job: ReviewJob) -> None:
+    С conn читает внутри транзакции вызывающего, иначе открывает своё соединение.
+    """
+    if conn is None:
+        with closing(connect()) as own:
+            yield from iter_review_pairs(submission_ids, own)
+        return
+    sql = """
+        SELECT t.submission_id, t.task_id, r.json, t.json, t.total
+        FROM teacher_reviews t JOIN results r ON r.submission_id = t.submission_id
+    """
+    if submission_ids is None:
+        cur = conn.execute(sql)
+    else:
+        ids = list(submission_ids)
+        if not ids:
+            return
+        cur = conn.execute(sql + f" WHERE t.submission_id IN ({','.join('?' * len(ids))})", ids)
+    for r in cur:
+        yield r[0], r[1], json.loads(r[2]), json.loads(r[3]), r[4]
+
+def set_job_results(items: List[Tuple[str, bool, Dict[str, Any]]]) -> None:
+    """Group commit: результаты и статусы пачки колбэков (submission_id, ok, result) одной транзакцией.
+
+    task_id берётся из строки решения; колбэк для неизвестного решения пропускается.
+    ok=False переводит задание в error, не трогая сохранённый результат.
+    В той же транзакции обновляются агрегаты согласия с оценками преподавателя.
+    """
+    from services import analytics
+    now = int(time.time())
     with closing(connect()) as conn, conn:
-        conn.execute(
+        conn.execute("BEGIN IMMEDIATE")
+        known: List[Tuple[str, str, bool, Dict[str, Any]]] = []
+        for submission_id, ok, result in items:
+            row = conn.execute("SELECT task_id FROM submissions WHERE id=?", (submission_id,)).fetchone()
+            if row:
+                known.append((submission_id, row[0], ok, result))
+        conn.executemany(
+            "INSERT OR REPLACE INTO results(submission_id, task_id, json, updated) VALUES(?,?,?,?)",
+            [(submission_id, task_id, json.dumps(result, ensure_ascii=False), now)
+             for submission_id, task_id, ok, result in known if ok],
+        )
+        conn.executemany(
             """
             INSERT OR REPLACE INTO review_jobs(submission_id, task_id, status, external_id, result_json, created, updated)
-            VALUES(?,?,?,?,?,
+            VALUES(?,?,?,NULL,?,
                     COALESCE((SELECT created FROM review_jobs WHERE submission_id=?), ?),
                     ?)
             """,
-            (
-                job.submission_id,
-                job.task_id,
-                job.status,
-                job.external_id,
-                json.dumps(job.result_json, ensure_ascii=False) if job.result_json else None,
-                job.submission_id,
-                job.created,
-                job.updated,
-            ),
+            [
+                (submission_id, task_id, "done" if ok else "error",
+                 json.dumps(result, ensure_ascii=False) if ok else None, submission_id, now, now)
+                for submission_id, task_id, ok, result in known
+            ],
         )
+        _sync_submission_status(conn, [item[0] for item in known])
+        analytics.record_reviews(conn, [item[0] for item in known if item[2]])
 
-def set_job_result(submission_id: str, task_id: str, result: Dict[str, Any]) -> None:
-    upsert_result(task_id, result)
-    upsert_review_job(
-        ReviewJob(
-            submission_id=submission_id,
-            task_id=task_id,
-            status="done",
-            external_id=None,
-            result_json=result,
-            created=int(time.time()),
-            updated=int(time.time()),
+def load_review_job(submission_id: str) -> Optional[Dict[str, Any]]:
+    with closing(connect()) as conn:
+        r = conn.execute(
+            "SELECT submission_id, task_id, status, external_id, result_json, created, updated "
+            "FROM review_jobs WHERE submission_id=?",
+            (submission_id,),
+        ).fetchone()
+        if not r:
+            return None
+        return {
+            "task_id": r[1],
+            "status": r[2],
+            "external_id": r[3],
+            "result_json": json.loads(r[4]) if r[4] else None,
+            "created": r[5],
+            "updated": r[6],
+        }
+
+def count_active_jobs() -> int:
+    with closing(connect()) as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM review_jobs WHERE status IN ('queued','processing')"
+        ).fetchone()[0]
+
+def update_job_status(submission_id: str, status: str, from_statuses: Tuple[str, ...]) -> None:
+    marks = ",".join("?" * len(from_statuses))
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            f"UPDATE review_jobs SET status=?, updated=? WHERE submission_id=? AND status IN ({marks})",
+            (status, int(time.time()), submission_id, *from_statuses),
         )
-    )
+        _sync_submission_status(conn, [submission_id])
 
-def load_review_jobs() -> Dict[str, Dict[str, Any]]:
+def claim_dispatches(now: int, limit: int, lease_seconds: int) -> List[Dict[str, Any]]:
+    """Забирает подошедшие записи очереди, сдвигая next_attempt на время аренды.
+
+    Так одну запись не отправят дважды фоновый воркер приложения и CLI-загрузчик.
+    Аренда должна покрывать отправку всех забранных записей, поэтому забирать
+    стоит столько, сколько сразу уходит в отправку.
+    """
     with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                """
+                SELECT submission_id, task_id, payload, attempts FROM dispatch_queue
+                WHERE state='pending' AND next_attempt<=? ORDER BY next_attempt LIMIT ?
+                """,
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE dispatch_queue SET next_attempt=? WHERE submission_id=?",
+                [(now + lease_seconds, r[0]) for r in rows],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return [
+            {"submission_id": r[0], "task_id": r[1], "payload": json.loads(r[2]), "attempts": r[3]}
+            for r in rows
+        ]
+
+def next_dispatch_at() -> Optional[int]:
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT MIN(next_attempt) FROM dispatch_queue WHERE state='pending'").fetchone()
+        return row[0] if row else None
+
+def reschedule_dispatch(submission_id: str, attempts: int, next_attempt: int, error: str) -> None:
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            "UPDATE dispatch_queue SET attempts=?, next_attempt=?, last_error=? WHERE submission_id=?",
+            (attempts, next_attempt, error, submission_id),
+        )
+
+def finish_dispatch(submission_id: str, ok: bool, error: Optional[str] = None) -> None:
+    """Успех: задание уходит из очереди, job queued→processing. Ошибка: остаётся как failed для повтора."""
+    now = int(time.time())
+    with closing(connect()) as conn, conn:
+        if ok:
+            conn.execute("DELETE FROM dispatch_queue WHERE submission_id=?", (submission_id,))
+        else:
+            conn.execute(
+                "UPDATE dispatch_queue SET state='failed', last_error=? WHERE submission_id=?",
+                (error, submission_id),
+            )
+        conn.execute(
+            "UPDATE review_jobs SET status=?, updated=? WHERE submission_id=? AND status='queued'",
+            ("processing" if ok else "error", now, submission_id),
+        )
+        _sync_submission_status(conn, [submission_id])
+
+def retry_dispatch(submission_id: str) -> bool:
+    now = int(time.time())
+    with closing(connect()) as conn, conn:
         cur = conn.execute(
-            "SELECT submission_id, task_id, status, external_id, result_json, created, updated FROM review_jobs"
+            """
+            UPDATE dispatch_queue SET state='pending', attempts=0, next_attempt=?, last_error=NULL
+            WHERE submission_id=? AND state='failed'
+            """,
+            (now, submission_id),
         )
-        return {
-            r[0]: {
-                "task_id": r[1],
-                "status": r[2],
-                "external_id": r[3],
-                "result_json": json.loads(r[4]) if r[4] else None,
-                "created": r[5],
-                "updated": r[6],
-            }
-            for r in cur.fetchall()
-        }
+        if cur.rowcount == 0:
+            return False
+        conn.execute(
+            "UPDATE review_jobs SET status='queued', updated=? WHERE submission_id=? AND status='error'",
+            (now, submission_id),
+        )
+        _sync_submission_status(conn, [submission_id])
+    return True
@@ -0,0 +1,176 @@
+from __future__ import annotations
+import json, sqlite3
+from contextlib import closing
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from db import connect
+from repository import iter_review_pairs
+
+# Согласие AI и преподавателя по критериям (таблица 2x2 на (задание, критерий):
+# n{ai}{teacher}, 1 — «выполнено») и разница итоговых оценок teacher - AI.
+# Агрегаты хранятся в agreement_stats/score_delta_stats и обновляются на разницу
+# вкладов при каждой новой оценке; вклад решения запоминается в agreement_pairs.
+# record_reviews/rebuild работают в транзакции вызывающего (BEGIN IMMEDIATE), вместе
+# с записью самой оценки, поэтому агрегаты не расходятся с оценками после сбоя.
+
+_CELLS = ["n00", "n01", "n10", "n11"]
+_DELTA_COLS = ["n", "sum_delta", "sum_sq_delta", "sum_abs_delta"]
+
+def _pair_contribution(result: Dict[str, Any], teacher: List[Dict[str, Any]], teacher_total: int) -> Dict[str, Any]:
+    ai_criteria = result.get("criteria") or []
+    rows = [
+        [t.get("name") or a.get("name") or f"#{i + 1}", bool(a.get("passed")), bool(t.get("passed"))]
+        for i, (a, t) in enumerate(zip(ai_criteria, teacher))
+    ]
+    ai_total = min(sum(1 for a in ai_criteria if a.get("passed")), 10)
+    return {"criteria": rows, "ai_total": ai_total, "teacher_total": int(teacher_total)}
+
+def _frames(contribs: Iterable[Tuple[str, Dict[str, Any]]], sign: int = 1) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Длинная таблица критериев и таблица итогов; sign=-1 — вклад, который нужно вычесть."""
+    crit: List[Tuple[str, str, bool, bool, int]] = []
+    totals: List[Tuple[str, int, int, int]] = []
+    for task_id, c in contribs:
+        crit.extend((task_id, name, ai, teacher, sign) for name, ai, teacher in c["criteria"])
+        totals.append((task_id, c["ai_total"], c["teacher_total"], sign))
+    return (
+        pd.DataFrame(crit, columns=["task_id", "criterion", "ai", "teacher", "sign"]),
+        pd.DataFrame(totals, columns=["task_id", "ai_total", "teacher_total", "sign"]),
+    )
+
+def criterion_counts(crit: pd.DataFrame) -> pd.DataFrame:
+    """Таблица сопряжённости по (task_id, criterion) без цикла по строкам."""
+    if crit.empty:
+        return pd.DataFrame(columns=_CELLS, index=pd.MultiIndex.from_tuples([], names=["task_id", "criterion"]))
+    cell = crit["ai"].to_numpy(np.int8) * 2 + crit["teacher"].to_numpy(np.int8)
+    onehot = (cell[:, None] == np.arange(4)[None, :]) * crit["sign"].to_numpy(np.int64)[:, None]
+    frame = pd.DataFrame(onehot, columns=_CELLS)
+    frame["task_id"], frame["criterion"] = crit["task_id"].to_numpy(), crit["criterion"].to_numpy()
+    return frame.groupby(["task_id", "criterion"], sort=False)[_CELLS].sum()
+
+def delta_sums(totals: pd.DataFrame) -> pd.DataFrame:
+    if totals.empty:
+        return pd.DataFrame(columns=_DELTA_COLS, index=pd.Index([], name="task_id"))
+    delta = (totals["teacher_total"] - totals["ai_total"]).to_numpy(np.float64)
+    sign = totals["sign"].to_numpy(np.float64)
+    frame = pd.DataFrame({
+        "task_id": totals["task_id"].to_numpy(),
+        "n": sign,
+        "sum_delta": sign * delta,
+        "sum_sq_delta": sign * delta ** 2,
+        "sum_abs_delta": sign * np.abs(delta),
+    })
+    return frame.groupby("task_id", sort=False)[_DELTA_COLS].sum()
+
+def agreement_table(counts: pd.DataFrame) -> pd.DataFrame:
+    """Доля совпадений и каппа Коэна по строкам таблицы счётчиков n00..n11."""
+    c = counts[_CELLS].to_numpy(np.float64)
+    n = c.sum(axis=1)
+    safe_n = np.where(n > 0, n, 1.0)
+    po = (c[:, 0] + c[:, 3]) / safe_n
+    ai_pass = (c[:, 2] + c[:, 3]) / safe_n
+    teacher_pass = (c[:, 1] + c[:, 3]) / safe_n
+    pe = ai_pass * teacher_pass + (1 - ai_pass) * (1 - teacher_pass)
+    # pe == 1: обе стороны всегда ставят одно и то же — каппа не определена, берём 1 при полном совпадении
+    kappa = np.where(pe < 1, (po - pe) / np.where(pe < 1, 1 - pe, 1.0), np.where(po == 1, 1.0, np.nan))
+    out = counts[_CELLS].astype(np.int64).copy()
+    out["n"] = n.astype(np.int64)
+    out["agreement"] = np.where(n > 0, po, np.nan)
+    out["ai_pass_rate"] = np.where(n > 0, ai_pass, np.nan)
+    out["teacher_pass_rate"] = np.where(n > 0, teacher_pass, np.nan)
+    out["kappa"] = np.where(n > 0, kappa, np.nan)
+    return out
+
+def _apply(conn, counts: pd.DataFrame, deltas: pd.DataFrame) -> None:
+    conn.executemany(
+        """
+        INSERT INTO agreement_stats(task_id, criterion, n00, n01, n10, n11) VALUES(?,?,?,?,?,?)
+        ON CONFLICT(task_id, criterion) DO UPDATE SET
+            n00 = n00 + excluded.n00, n01 = n01 + excluded.n01,
+            n10 = n10 + excluded.n10, n11 = n11 + excluded.n11
+        """,
+        [(t, c, *map(int, row)) for (t, c), row in zip(counts.index, counts[_CELLS].to_numpy())],
+    )
+    conn.executemany(
+        """
+        INSERT INTO score_delta_stats(task_id, n, sum_delta, sum_sq_delta, sum_abs_delta) VALUES(?,?,?,?,?)
+        ON CONFLICT(task_id) DO UPDATE SET
+            n = n + excluded.n, sum_delta = sum_delta + excluded.sum_delta,
+            sum_sq_delta = sum_sq_delta + excluded.sum_sq_delta,
+            sum_abs_delta = sum_abs_delta + excluded.sum_abs_delta
+        """,
+        [(t, int(row[0]), *map(float, row[1:])) for t, row in zip(deltas.index, deltas[_DELTA_COLS].to_numpy())],
+    )
+
+def record_reviews(conn: sqlite3.Connection, submission_ids: List[str]) -> None:
+    """Инкрементально учитывает новые или изменённые пары оценок AI/преподаватель."""
+    if not submission_ids:
+        return
+    new = {sid: (task_id, _pair_contribution(result, teacher, total))
+           for sid, task_id, result, teacher, total in iter_review_pairs(submission_ids, conn)}
+    if not new:
+        return
+    marks = ",".join("?" * len(new))
+    old = {
+        r[0]: (r[1], json.loads(r[2]))
+        for r in conn.execute(
+            f"SELECT submission_id, task_id, json FROM agreement_pairs WHERE submission_id IN ({marks})",
+            list(new),
+        )
+    }
+    old_crit, old_totals = _frames(old.values(), sign=-1)
+    new_crit, new_totals = _frames(new.values())
+    _apply(conn,
+           criterion_counts(pd.concat([old_crit, new_crit], ignore_index=True)),
+           delta_sums(pd.concat([old_totals, new_totals], ignore_index=True)))
+    conn.executemany(
+        "INSERT OR REPLACE INTO agreement_pairs(submission_id, task_id, json) VALUES(?,?,?)",
+        [(sid, task_id, json.dumps(c, ensure_ascii=False)) for sid, (task_id, c) in new.items()],
+    )
+
+def rebuild(conn: Optional[sqlite3.Connection] = None) -> None:
+    """Полный пересчёт агрегатов по всем заданиям (после ручных правок БД или смены формата)."""
+    if conn is None:
+        with closing(connect()) as own, own:
+            own.execute("BEGIN IMMEDIATE")
+            rebuild(own)
+        return
+    contribs = {sid: (task_id, _pair_contribution(result, teacher, total))
+                for sid, task_id, result, teacher, total in iter_review_pairs(conn=conn)}
+    crit, totals = _frames(contribs.values())
+    conn.execute("DELETE FROM agreement_stats")
+    conn.execute("DELETE FROM score_delta_stats")
+    conn.execute("DELETE FROM agreement_pairs")
+    _apply(conn, criterion_counts(crit), delta_sums(totals))
+    conn.executemany(
+        "INSERT INTO agreement_pairs(submission_id, task_id, json) VALUES(?,?,?)",
+        [(sid, task_id, json.dumps(c, ensure_ascii=False)) for sid, (task_id, c) in contribs.items()],
+    )
+
+def load_agreement(task_id: Optional[str] = None) -> pd.DataFrame:
+    where, args = ("WHERE task_id=?", (task_id,)) if task_id else ("", ())
+    with closing(connect()) as conn:
+        counts = pd.read_sql_query(
+            f"SELECT task_id, criterion, n00, n01, n10, n11 FROM agreement_stats {where} ORDER BY task_id, criterion",
+            conn, params=args,
+        ).set_index(["task_id", "criterion"])
+    return agreement_table(counts[counts[_CELLS].sum(axis=1) > 0])
+
+def load_score_deltas(task_id: Optional[str] = None) -> pd.DataFrame:
+    where, args = ("WHERE task_id=?", (task_id,)) if task_id else ("", ())
+    with closing(connect()) as conn:
+        sums = pd.read_sql_query(
+            f"SELECT task_id, n, sum_delta, sum_sq_delta, sum_abs_delta FROM score_delta_stats {where} ORDER BY task_id",
+            conn, params=args,
+        ).set_index("task_id")
+    n = sums["n"].to_numpy(np.float64)
+    safe_n = np.where(n > 0, n, 1.0)
+    mean = sums["sum_delta"].to_numpy(np.float64) / safe_n
+    out = pd.DataFrame(index=sums.index)
+    out["n"] = sums["n"].astype(np.int64)
+    out["mean_delta"] = np.where(n > 0, mean, np.nan)
+    out["mean_abs_delta"] = np.where(n > 0, sums["sum_abs_delta"].to_numpy(np.float64) / safe_n, np.nan)
+    out["std_delta"] = np.where(
+        n > 0, np.sqrt(np.maximum(sums["sum_sq_delta"].to_numpy(np.float64) / safe_n - mean ** 2, 0.0)), np.nan
+    )
+    return out
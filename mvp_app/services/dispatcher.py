@@ -0,0 +1,153 @@
+from __future__ import annotations
+import logging, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlparse
+from config import (
+    DISPATCH_MAX_ATTEMPTS, DISPATCH_BACKOFF_SECONDS, REQUEST_TIMEOUT, PUBLIC_CALLBACK_BASE, PREPROCESS_TIMEOUT,
+    UPLOAD_ORPHAN_MAX_AGE,
+)
+from models import Submission
+from repository import (
+    create_submissions, claim_dispatches, next_dispatch_at, reschedule_dispatch,
+    finish_dispatch, retry_dispatch,
+)
+from services.llm_client import call_orchestrator_async
+from services import page_pipeline, upload_store
+
+# Отправка решений в relay вне потока Streamlit.
+# Очередь хранится в таблице dispatch_queue, поэтому переживает перезапуск приложения.
+
+log = logging.getLogger("dispatcher")
+
+_wake = threading.Event()
+_started = False
+_IDLE_SECONDS = 30.0
+# Аренда покрывает одну отправку: подготовку страниц и сам запрос. Поэтому записи
+# забираются по одной непосредственно перед отправкой, а не пачкой впрок.
+_LEASE_SECONDS = int(PREPROCESS_TIMEOUT + REQUEST_TIMEOUT) + 30
+_DRAIN_POLL_SECONDS = 1.0
+_SWEEP_INTERVAL = 3600.0
+_next_sweep = 0.0
+
+def build_payload(task: Dict[str, Any], sub: Submission) -> Dict[str, Any]:
+    base = PUBLIC_CALLBACK_BASE.rstrip("/")
+    file_url = f"{base}/uploads/{os.path.basename(sub.file_path)}" if sub.file_path else None
+    return {
+        "submission_id": sub.id,
+        "task_id": task["id"],
+        "student_id": sub.student_id,
+        "task_text": task.get("condition", ""),
+        "mode": sub.mode,
+        "text": sub.text or "",
+        "file_url": file_url,
+        "callback_url": f"{base}/callback",
+    }
+
+def submit(sub: Submission, payload: Dict[str, Any]) -> bool:
+    """Решение, queued-задание и запись очереди одной транзакцией; False — такое решение уже есть."""
+    created = create_submissions([(sub, payload)]) > 0
+    _wake.set()
+    return created
+
+def retry(submission_id: str) -> bool:
+    ok = retry_dispatch(submission_id)
+    _wake.set()
+    return ok
+
+def _backoff(attempts: int) -> float:
+    return min(DISPATCH_BACKOFF_SECONDS * (2 ** (attempts - 1)), 300.0)
+
+def slim_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Подставляет file_refs со сжатыми непустыми страницами вместо исходного файла.
+
+    Если страницы не удалось подготовить (таймаут, ошибка рендера, битый файл),
+    LLM получает исходный файл, как раньше.
+    """
+    if payload.get("mode") != "file" or not payload.get("file_url") or "file_refs" in payload:
+        return payload
+    name = os.path.basename(urlparse(payload["file_url"]).path)
+    try:
+        manifest = page_pipeline.ensure(name, PREPROCESS_TIMEOUT)
+        refs = page_pipeline.llm_file_refs(name, manifest, PUBLIC_CALLBACK_BASE.rstrip("/")) if manifest else []
+    except Exception:
+        log.exception("page preprocessing failed for %s, sending the original file", name)
+        refs = []
+    return {**payload, "file_refs": refs or [{"url": payload["file_url"]}]}
+
+def dispatch_one(item: Dict[str, Any]) -> bool:
+    ok, err = call_orchestrator_async(slim_payload(item["payload"]))
+    if ok:
+        finish_dispatch(item["submission_id"], True)
+        return True
+    attempts = item["attempts"] + 1
+    if attempts >= DISPATCH_MAX_ATTEMPTS:
+        finish_dispatch(item["submission_id"], False, err)
+    else:
+        reschedule_dispatch(item["submission_id"], attempts, int(time.time() + _backoff(attempts)), err or "")
+    return False
+
+def _sweep_if_due() -> None:
+    global _next_sweep
+    if time.monotonic() < _next_sweep:
+        return
+    _next_sweep = time.monotonic() + _SWEEP_INTERVAL
+    try:
+        removed = upload_store.sweep_orphans(UPLOAD_ORPHAN_MAX_AGE)
+    except Exception:
+        log.exception("orphan upload sweep failed")
+        return
+    if removed:
+        log.info("removed %d unsubmitted uploads", removed)
+
+def _run_once() -> float:
+    _sweep_if_due()
+    while True:
+        items = claim_dispatches(int(time.time()), 1, _LEASE_SECONDS)
+        if not items:
+            break
+        dispatch_one(items[0])
+    nxt = next_dispatch_at()
+    if nxt is None:
+        return _IDLE_SECONDS
+    return max(0.0, min(nxt - time.time(), _IDLE_SECONDS))
+
+def _loop() -> None:
+    while True:
+        _wake.clear()
+        try:
+            delay = _run_once()
+        except Exception:
+            log.exception("dispatch loop failed")
+            delay = DISPATCH_BACKOFF_SECONDS
+        _wake.wait(timeout=delay)
+
+def drain(concurrency: int, on_result: Optional[Callable[[Dict[str, Any], bool], None]] = None) -> None:
+    """Отправляет всю очередь (включая повторы по backoff) в `concurrency` потоков и возвращается."""
+    result_lock = threading.Lock()
+
+    def worker() -> None:
+        while True:
+            items = claim_dispatches(int(time.time()), 1, _LEASE_SECONDS)
+            if not items:
+                nxt = next_dispatch_at()
+                if nxt is None:
+                    return
+                # Запись может быть в аренде у соседнего потока — проверяем снова вскоре
+                time.sleep(min(max(0.1, nxt - time.time()), _DRAIN_POLL_SECONDS))
+                continue
+            ok = dispatch_one(items[0])
+            if on_result:
+                with result_lock:
+                    on_result(items[0], ok)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for fut in [pool.submit(worker) for _ in range(concurrency)]:
+            fut.result()
+
+def start_once() -> None:
+    global _started
+    if _started:
+        return
+    threading.Thread(target=_loop, name="dispatcher", daemon=True).start()
+    _started = True
@@ -0,0 +1,77 @@
+from __future__ import annotations
+import csv, itertools, re, time
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+from repository import iter_grade_rows
+
+# Выгрузка оценок в формате листа оценивания Moodle («Offline grading worksheet»).
+# Лист загружается в Moodle в одно задание, поэтому CSV пишется по одному заданию,
+# а XLSX со всеми заданиями — по листу на задание.
+# Строки идут генератором прямо из курсора SQLite, поэтому память не зависит от числа решений.
+
+MAX_GRADE = 10
+COLUMNS = [
+    "Identifier", "Full name", "Task", "Status", "Grade", "Maximum Grade", "AI grade",
+    "Last modified (submission)", "Last modified (grade)", "Feedback comments",
+]
+
+def _moodle_time(ts: Optional[int]) -> str:
+    return time.strftime("%A, %d %B %Y, %I:%M %p", time.localtime(ts)) if ts else "-"
+
+def _feedback(criteria: Optional[List[Dict[str, Any]]]) -> str:
+    if not criteria:
+        return ""
+    return "\n".join(
+        f"{'✔' if c.get('passed') else '✘'} {c.get('name', '')}" + (f": {c['details']}" if c.get("details") else "")
+        for c in criteria
+    )
+
+def _row(rec: Dict[str, Any]) -> List[Any]:
+    criteria = (rec["result"] or {}).get("criteria") or []
+    ai_total = min(sum(1 for c in criteria if c.get("passed")), MAX_GRADE) if rec["result"] else ""
+    student_id = rec["student_id"] or ""
+    return [
+        f"Participant {student_id}" if student_id.isdigit() else student_id,
+        rec["student_name"] or "",
+        rec["task_id"],
+        rec["status"],
+        rec["teacher_total"] if rec["teacher_total"] is not None else "",
+        MAX_GRADE,
+        ai_total,
+        _moodle_time(rec["uploaded_at"]),
+        _moodle_time(rec["teacher_updated"]),
+        _feedback(rec["teacher_criteria"]),
+    ]
+
+def iter_rows(task_id: str) -> Iterator[List[Any]]:
+    yield COLUMNS
+    for rec in iter_grade_rows(task_id):
+        yield _row(rec)
+
+def write_csv(out: TextIO, task_id: str) -> int:
+    writer = csv.writer(out)
+    count = -1
+    for count, row in enumerate(iter_rows(task_id)):
+        writer.writerow(row)
+    return max(count, 0)
+
+def _sheet_name(task_id: str) -> str:
+    # Ограничения Excel на имя листа: до 31 символа, без []:*?/\
+    return re.sub(r"[\[\]:*?/\\]", "_", task_id)[:31] or "Grades"
+
+def write_xlsx(path: str, task_id: Optional[str] = None) -> int:
+    import xlsxwriter
+    # constant_memory: xlsxwriter сбрасывает каждую строку на диск сразу после записи.
+    # Строки идут по task_id, поэтому каждый лист заполняется сверху вниз за один проход.
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    wrap = workbook.add_format({"text_wrap": True})
+    count = 0
+    for tid, recs in itertools.groupby(iter_grade_rows(task_id), key=lambda rec: rec["task_id"]):
+        sheet = workbook.add_worksheet(_sheet_name(tid))
+        sheet.write_row(0, 0, COLUMNS)
+        for i, rec in enumerate(recs, start=1):
+            sheet.write_row(i, 0, _row(rec), wrap)
+            count += 1
+    if not workbook.worksheets():
+        workbook.add_worksheet("Grades").write_row(0, 0, COLUMNS)
+    workbook.close()
+    return count
@@ -1,12 +1,34 @@
 from __future__ import annotations
-import requests
-from typing import Any, Dict, Optional, Tuple
-from config import REQUEST_TIMEOUT, LLM_API_URL
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+from config import REQUEST_TIMEOUT, LLM_API_URL, DISPATCH_POOL_SIZE
+
+if TYPE_CHECKING:
+    import requests
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+def _get_session() -> requests.Session:
+    # Одна сессия на процесс: keep-alive соединения к relay переиспользуются
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # requests импортируется при первой отправке (в фоновом потоке), а не при старте UI
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=DISPATCH_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
 
 def call_orchestrator_async(payload: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
     try:
         url = LLM_API_URL.rstrip("/") + "/reviews/async"
-        resp = requests.post(url, json=payload, timeout=REQUEST_TIMEOUT)
+        resp = _get_session().post(url, json=payload, timeout=REQUEST_TIMEOUT)
         if resp.status_code >= 400:
             return False, f"{resp.status_code} {resp.text[:200]}"
         return True, None
@@ -0,0 +1,280 @@
+from __future__ import annotations
+import json, logging, os, shutil, threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from config import (
+    UPLOAD_DIR, PAGES_DIR, PAGE_WORKERS, THUMB_MAX_SIDE, PAGE_IMAGE_FORMAT,
+    LLM_IMAGE_MAX_SIDE, BLANK_PAGE_INK_RATIO, PDF_DPI_DEFAULT,
+)
+
+# Фоновая подготовка превью и страниц для LLM. Каждый каталог готов, когда в нём есть
+# manifest.json: он пишется последним.
+# - Превью для UI: PAGES_DIR/<имя файла>/thumb_NNN.jpg при DPI из боковой панели.
+#   При смене DPI каталог перерисовывается целиком.
+# - Страницы для LLM: PAGES_DIR/llm/<имя файла>/page_NNN_d<DPI>.webp|jpg всегда при
+#   PDF_DPI_DEFAULT (уменьшены до LLM_IMAGE_MAX_SIDE, пустые пропущены). Их URL уже
+#   могли уйти в relay, поэтому каталог пишется один раз и удаляется только вместе с файлом.
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger("page-pipeline")
+
+_MANIFEST = "manifest.json"
+_PREVIEW, _LLM = "preview", "llm"
+_pool: Optional[ProcessPoolExecutor] = None
+# _pending и _failed меняются и из потока скрипта Streamlit, и из диспетчера — только под _lock
+_pending: Dict[Tuple[str, str], Tuple[Future, int]] = {}    # (имя файла, вид) -> (задача рендера, DPI)
+_failed: Dict[Tuple[str, str], int] = {}                    # (имя файла, вид) -> DPI, на котором рендер упал
+_lock = threading.Lock()
+
+def _asset_dir(name: str, kind: str) -> str:
+    if kind == _LLM:
+        return os.path.join(PAGES_DIR, _LLM, name)
+    return os.path.join(PAGES_DIR, name)
+
+def _open_pages(src_path: str, dpi: int):
+    from PIL import Image, ImageOps
+    if src_path.lower().endswith(".pdf"):
+        from services.pdf_renderer import iter_pdf_pages
+        yield from iter_pdf_pages(src_path, dpi)
+        return
+    with Image.open(src_path) as img:
+        yield ImageOps.exif_transpose(img)
+
+def _save_page(img, path: str, fmt: str) -> None:
+    if fmt == "WEBP":
+        img.save(path, "WEBP", quality=80, method=4)
+    else:
+        img.save(path, "JPEG", quality=82, optimize=True, progressive=True)
+
+# Сторона изображения, на которой считаются «чернила»: 2px штрих ручки на ней ещё тёмный
+_INK_MAX_SIDE = 2000
+
+def _ink_ratio(img) -> float:
+    """Доля пикселей заметно темнее фона страницы.
+
+    Фон — медианная яркость: у скана или фото он бывает серым, поэтому порог
+    относительный, а не фиксированный. Большие изображения уменьшаются только
+    после MinFilter, чтобы тонкие штрихи не растворились в фоне.
+    """
+    from PIL import ImageFilter
+    gray = img.convert("L")
+    factor = -(-max(gray.size) // _INK_MAX_SIDE)
+    if factor > 1:
+        gray = gray.filter(ImageFilter.MinFilter(2 * factor - 1)).reduce(factor)
+    hist = gray.histogram()
+    total = max(sum(hist), 1)
+    acc, background = 0, 255
+    for level, n in enumerate(hist):
+        acc += n
+        if acc * 2 >= total:
+            background = level
+            break
+    return sum(hist[:int(background * 0.75)]) / total
+
+def _is_blank(img) -> bool:
+    return _ink_ratio(img) < BLANK_PAGE_INK_RATIO
+
+def _write_manifest(out_dir: str, manifest: Dict[str, Any]) -> None:
+    with open(os.path.join(out_dir, _MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+
+def _render_assets(src_path: str, dpi: int, preview_dir: Optional[str], llm_dir: Optional[str],
+                   fmt: str) -> Dict[str, Dict[str, Any]]:
+    """Выполняется в процессе пула: превью и/или страницы для LLM за один проход по файлу.
+
+    Возвращает manifest каждого подготовленного вида: {"preview": ..., "llm": ...}.
+    """
+    dirs = {kind: d for kind, d in ((_PREVIEW, preview_dir), (_LLM, llm_dir)) if d}
+    tmp = {kind: f"{d}.{os.getpid()}.tmp" for kind, d in dirs.items()}
+    for tmp_dir in tmp.values():
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+    ext = ".webp" if fmt == "WEBP" else ".jpg"
+    thumbs: List[Dict[str, Any]] = []
+    pages: List[Dict[str, Any]] = []
+    for i, img in enumerate(_open_pages(src_path, dpi), start=1):
+        img = img.convert("RGB")
+        if _PREVIEW in tmp:
+            thumb_name = f"thumb_{i:03d}.jpg"
+            thumb = img.copy()
+            thumb.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+            thumb.save(os.path.join(tmp[_PREVIEW], thumb_name), "JPEG", quality=70, optimize=True)
+            thumbs.append({"page": i, "thumb": thumb_name})
+        if _LLM in tmp:
+            # Пустота оценивается по полному разрешению: на превью штрихи ручки светлеют до фона
+            entry: Dict[str, Any] = {"page": i, "image": f"page_{i:03d}_d{dpi}{ext}", "blank": _is_blank(img)}
+            if max(img.size) > LLM_IMAGE_MAX_SIDE:
+                img.thumbnail((LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE))
+            _save_page(img, os.path.join(tmp[_LLM], entry["image"]), fmt)
+            entry["width"], entry["height"] = img.width, img.height
+            pages.append(entry)
+    manifests: Dict[str, Dict[str, Any]] = {}
+    if _PREVIEW in tmp:
+        manifests[_PREVIEW] = {"source": os.path.basename(src_path), "dpi": dpi, "pages": thumbs}
+        _write_manifest(tmp[_PREVIEW], manifests[_PREVIEW])
+        shutil.rmtree(dirs[_PREVIEW], ignore_errors=True)
+        os.replace(tmp[_PREVIEW], dirs[_PREVIEW])
+    if _LLM in tmp:
+        # Пустые страницы не отправляются, но если пусто всё — отправляем всё: лишняя страница
+        # дешевле потерянной работы студента
+        if any(not p["blank"] for p in pages):
+            for p in pages:
+                if p["blank"]:
+                    os.remove(os.path.join(tmp[_LLM], p["image"]))
+                    p["image"] = None
+        manifest = {"source": os.path.basename(src_path), "dpi": dpi, "format": fmt,
+                    "max_side": LLM_IMAGE_MAX_SIDE, "pages": pages}
+        _write_manifest(tmp[_LLM], manifest)
+        try:
+            os.replace(tmp[_LLM], dirs[_LLM])
+        except OSError:
+            # Каталог уже готов (параллельный рендер): его страницы могли уйти в relay — не трогаем
+            shutil.rmtree(tmp[_LLM], ignore_errors=True)
+            manifest = _read_manifest(dirs[_LLM]) or manifest
+        manifests[_LLM] = manifest
+    return manifests
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_all_start_methods, get_context
+        # Не fork: к этому моменту в процессе уже работают потоки Streamlit, waitress и диспетчера
+        method = "forkserver" if "forkserver" in get_all_start_methods() else "spawn"
+        _pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS, mp_context=get_context(method))
+    return _pool
+
+def _submit_to_pool(*args: Any) -> Future:
+    """Вызывать под _lock. Пул, сломанный гибелью воркера (OOM, SIGKILL), пересоздаётся."""
+    global _pool
+    from concurrent.futures.process import BrokenProcessPool
+    try:
+        return _get_pool().submit(*args)
+    except BrokenProcessPool:
+        log.warning("page render pool is broken, recreating it")
+        _pool.shutdown(wait=False)
+        _pool = None
+        return _get_pool().submit(*args)
+
+def _read_manifest(out_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(out_dir, _MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def load_manifest(name: str) -> Optional[Dict[str, Any]]:
+    """manifest страниц для LLM или None, если они ещё не готовы."""
+    return _read_manifest(_asset_dir(name, _LLM))
+
+def _poll(key: Tuple[str, str]) -> bool:
+    """Идёт ли рендер; вызывать под _lock."""
+    entry = _pending.get(key)
+    if entry is None:
+        return False
+    fut, dpi = entry
+    if not fut.done():
+        return True
+    del _pending[key]
+    if not fut.cancelled() and fut.exception() is not None:
+        _failed[key] = dpi
+    return False
+
+def has_pending() -> bool:
+    with _lock:
+        return any([_poll(key) for key in list(_pending)])
+
+def _wanted(name: str, kind: str, dpi: int) -> bool:
+    """Нужен ли новый рендер этого вида; вызывать под _lock."""
+    key = (name, kind)
+    if _poll(key) or _failed.get(key) == dpi:
+        return False
+    if kind == _LLM:
+        # Страницы для LLM пишутся один раз и не перерисовываются
+        return load_manifest(name) is None
+    manifest = _read_manifest(_asset_dir(name, _PREVIEW))
+    return not (manifest and manifest.get("dpi") == dpi)
+
+def _submit(name: str, dpi: int, kinds: List[str]) -> None:
+    """Вызывать под _lock."""
+    dirs = {kind: _asset_dir(name, kind) for kind in kinds}
+    for d in dirs.values():
+        os.makedirs(os.path.dirname(d), exist_ok=True)
+    src_path = os.path.join(UPLOAD_DIR, name)
+    fut = _submit_to_pool(_render_assets, src_path, dpi, dirs.get(_PREVIEW), dirs.get(_LLM), PAGE_IMAGE_FORMAT)
+    for kind in kinds:
+        _failed.pop((name, kind), None)
+        _pending[(name, kind)] = (fut, dpi)
+
+def _schedule(name: str, preview_dpi: Optional[int]) -> None:
+    """Ставит недостающие страницы для LLM и, если задан preview_dpi, превью; вызывать под _lock."""
+    llm = _wanted(name, _LLM, PDF_DPI_DEFAULT)
+    preview = preview_dpi is not None and _wanted(name, _PREVIEW, preview_dpi)
+    if llm and preview and preview_dpi == PDF_DPI_DEFAULT:
+        # При DPI по умолчанию обе выдачи получаются из одного прохода по файлу
+        _submit(name, PDF_DPI_DEFAULT, [_PREVIEW, _LLM])
+        return
+    if llm:
+        _submit(name, PDF_DPI_DEFAULT, [_LLM])
+    if preview:
+        _submit(name, preview_dpi, [_PREVIEW])
+
+def schedule(name: str, dpi: int) -> None:
+    """Ставит файл из UPLOAD_DIR в очередь: превью при этом DPI и, заранее, страницы для LLM."""
+    try:
+        with _lock:
+            _schedule(name, dpi)
+    except Exception:
+        # Превью не критично: страницы для LLM при необходимости подготовит ensure()
+        log.exception("failed to schedule page render for %s", name)
+
+def ensure(name: str, timeout: float) -> Optional[Dict[str, Any]]:
+    """Готовый manifest для отправки в LLM: берёт уже отрендеренный или рендерит и ждёт."""
+    with _lock:
+        _schedule(name, None)
+        entry = _pending.get((name, _LLM))
+    if entry is not None:
+        # Ждём вне блокировки, чтобы не задерживать UI
+        try:
+            entry[0].result(timeout=timeout)
+        except Exception:
+            return None
+    return load_manifest(name)
+
+def thumbnails(name: str) -> Optional[List[str]]:
+    """Пути к превью страниц или None, если рендер ещё не закончен. Пустой список — рендер не удался."""
+    key = (name, _PREVIEW)
+    with _lock:
+        if _poll(key):
+            return None
+        if key in _failed:
+            return []
+    preview_dir = _asset_dir(name, _PREVIEW)
+    manifest = _read_manifest(preview_dir)
+    if manifest is None:
+        return None
+    return [os.path.join(preview_dir, p["thumb"]) for p in manifest["pages"]]
+
+def llm_file_refs(name: str, manifest: Dict[str, Any], base_url: str) -> List[Dict[str, Any]]:
+    """file_refs для LLM: по одному сжатому изображению на непустую страницу, в порядке страниц.
+
+    pages не указывается: в FileRef это страницы самого файла по ссылке, а в изображении она одна.
+    """
+    return [{"url": f"{base_url}/pages/{name}/{p['image']}"} for p in manifest["pages"] if p.get("image")]
+
+def asset_path(name: str, filename: str) -> str:
+    return os.path.join(_asset_dir(name, _LLM), filename)
+
+def discard(name: str) -> None:
+    """Удаляет превью и страницы файла; вызывается, только когда на файл не ссылается ни одно решение."""
+    with _lock:
+        entries = [_pending.pop((name, kind), None) for kind in (_PREVIEW, _LLM)]
+        for kind in (_PREVIEW, _LLM):
+            _failed.pop((name, kind), None)
+    for entry in entries:
+        if entry is not None:
+            entry[0].cancel()
+    for kind in (_PREVIEW, _LLM):
+        shutil.rmtree(_asset_dir(name, kind), ignore_errors=True)
@@ -1,19 +1,55 @@
 from __future__ import annotations
-from typing import Any, Dict, List
-from PIL import Image, ImageDraw
-try:
-    import fitz  # PyMuPDF
-except Exception:
-    fitz = None
+import io
+from typing import TYPE_CHECKING, Iterable, Iterator, Tuple
 
-def render_pdf_pages(file_bytes: bytes, dpi: int) -> List[Image.Image]:
+if TYPE_CHECKING:
+    from PIL import Image
+
+# PIL и PyMuPDF тяжёлые и нужны только воркерам рендера, поэтому импортируются лениво.
+
+def _fitz():
+    try:
+        import fitz  # PyMuPDF
+    except Exception:
+        return None
+    return fitz
+
+def iter_pdf_pages(path: str, dpi: int) -> Iterator[Image.Image]:
+    # Постранично, чтобы не держать весь документ в памяти воркера
+    fitz = _fitz()
     if fitz is None:
-        return []
-    pages: List[Image.Image] = []
-    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return
+    from PIL import Image
+    mat = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    with fitz.open(path) as doc:
         for page in doc:
-            mat = fitz.Matrix(dpi / 72.0, dpi / 72.0)
             pix = page.get_pixmap(matrix=mat, alpha=False)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            pages.append(img)
-    return pages
+            yield Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+# EXIF Orientation -> поворот в PyMuPDF (против часовой стрелки), чтобы фото с телефона не легли набок
+_EXIF_ROTATE = {3: 180, 6: 270, 8: 90}
+
+def merge_to_pdf(parts: Iterable[Tuple[str, bytes]], out_path: str) -> bool:
+    """Склеивает PDF и фото (имя, содержимое) в один PDF по порядку; False — нет PyMuPDF.
+
+    Фото вставляются без перекодирования, поэтому в памяти один исходный файл за раз.
+    """
+    fitz = _fitz()
+    if fitz is None:
+        return False
+    from PIL import Image
+    with fitz.open() as doc:
+        for name, data in parts:
+            if name.lower().endswith(".pdf"):
+                with fitz.open(stream=data, filetype="pdf") as src:
+                    doc.insert_pdf(src)
+                continue
+            with Image.open(io.BytesIO(data)) as img:
+                width, height = img.size
+                rotate = _EXIF_ROTATE.get(img.getexif().get(0x0112), 0)
+            if rotate in (90, 270):
+                width, height = height, width
+            page = doc.new_page(width=width, height=height)
+            page.insert_image(page.rect, stream=data, rotate=rotate)
+        doc.save(out_path, garbage=3, deflate=True)
+    return True
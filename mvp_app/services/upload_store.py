@@ -0,0 +1,130 @@
+from __future__ import annotations
+import hashlib, os, re, sqlite3, tempfile, time
+from contextlib import closing
+from typing import BinaryIO, Optional
+from config import UPLOAD_DIR, UPLOAD_CHUNK_SIZE
+from db import connect
+from services import page_pipeline
+
+# Контентно-адресуемое хранилище загрузок: файл лежит в UPLOAD_DIR под именем
+# <sha256><расширение>, одинаковые файлы хранятся один раз.
+# Счётчик ссылок в таблице blobs ведут строки submissions (см. repository).
+
+_BLOB_RE = re.compile(r"^([0-9a-f]{64})(\.[a-z0-9]{1,8})?$")
+
+def blob_etag(name: str) -> Optional[str]:
+    m = _BLOB_RE.match(name)
+    return m.group(1) if m else None
+
+def _safe_ext(original_name: str) -> str:
+    ext = os.path.splitext(original_name)[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+def store(fileobj: BinaryIO, original_name: str) -> str:
+    """Потоково пишет файл кусками, считая sha256, и возвращает имя блоба."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    if hasattr(fileobj, "seek"):
+        fileobj.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".incoming-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        name = digest.hexdigest() + _safe_ext(original_name)
+        path = os.path.join(UPLOAD_DIR, name)
+        # Под блокировкой записи: sweep_orphans не удалит файл между проверкой и записью строки
+        with closing(connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if os.path.exists(path):
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, path)
+                # Повторная загрузка ещё не отправленного файла продлевает ему жизнь до sweep_orphans
+                conn.execute(
+                    """
+                    INSERT INTO blobs(name, size, refs, created) VALUES(?,?,0,?)
+                    ON CONFLICT(name) DO UPDATE SET created = excluded.created WHERE refs <= 0
+                    """,
+                    (name, size, int(time.time())),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return name
+
+def acquire(conn: sqlite3.Connection, name: str) -> None:
+    """Добавляет ссылку на блоб; строка создаётся, если файла нет в таблице (например, старые загрузки)."""
+    if conn.execute("UPDATE blobs SET refs = refs + 1 WHERE name=?", (name,)).rowcount:
+        return
+    path = os.path.join(UPLOAD_DIR, name)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        raise FileNotFoundError(f"uploaded file {name} is missing") from None
+    conn.execute("INSERT INTO blobs(name, size, refs, created) VALUES(?,?,1,?)", (name, size, int(time.time())))
+
+def release(conn: sqlite3.Connection, name: str) -> None:
+    """Убирает ссылку на блоб. Файл без ссылок не удаляется сразу: то же содержимое может
+    держать незавершённая форма или пачка импорта, его удалит sweep_orphans по возрасту."""
+    conn.execute(
+        """
+        UPDATE blobs SET refs = refs - 1,
+            created = CASE WHEN refs <= 1 THEN ? ELSE created END
+        WHERE name=? AND refs > 0
+        """,
+        (int(time.time()), name),
+    )
+
+def remove(name: str) -> None:
+    page_pipeline.discard(name)
+    try:
+        os.remove(os.path.join(UPLOAD_DIR, name))
+    except FileNotFoundError:
+        pass
+
+def sweep_orphans(max_age: float) -> int:
+    """Удаляет блобы без ссылок старше max_age секунд и брошенные временные файлы.
+
+    Такие остаются, если сессия закончилась без отправки решения, импорт
+    прервался до записи пачки или удалено последнее решение с этим файлом.
+    """
+    cutoff = time.time() - max_age
+    with closing(connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            names = [r[0] for r in conn.execute(
+                "SELECT name FROM blobs WHERE refs <= 0 AND created < ?", (int(cutoff),)
+            )]
+            conn.executemany("DELETE FROM blobs WHERE name=?", [(n,) for n in names])
+            # Файлы удаляются до commit: store/acquire ждут блокировку записи и увидят,
+            # что файла уже нет, а не строку без файла
+            for name in names:
+                remove(name)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    try:
+        entries = list(os.scandir(UPLOAD_DIR))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        if entry.name.startswith(".incoming-") and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return len(names)
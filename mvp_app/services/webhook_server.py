@@ -1,35 +1,185 @@
 from __future__ import annotations
-import threading
-from flask import Flask, request, jsonify, send_from_directory
-from repository import set_job_result
-from config import WEBHOOK_PORT, UPLOAD_DIR
+import hmac, hashlib, json, logging, os, queue, sqlite3, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+from repository import set_job_results
+from config import (
+    WEBHOOK_PORT, UPLOAD_DIR, UPLOAD_CACHE_MAX_AGE, CALLBACK_HMAC_SECRET,
+    WEBHOOK_THREADS, WEBHOOK_QUEUE_SIZE, WEBHOOK_BATCH_SIZE, WEBHOOK_BATCH_WAIT,
+)
+from services import page_pipeline, upload_store
 
-_app = Flask("llm-callback-server")
+# Приёмник колбэков: запрос только проверяет подпись и кладёт результат в
+# ограниченную очередь, а единственный поток-писатель сохраняет их пачками.
+# Запуск отдельно: `python -m services.webhook_server` или любой WSGI-сервер
+# (`gunicorn -w 4 services.webhook_server:app`) — в каждом воркере свой писатель.
+# Flask импортируется в create_app(), т.е. уже в фоновом потоке сервера, а не при старте UI.
+
+log = logging.getLogger("llm-callback-server")
+
+_app = None
+_app_lock = threading.Lock()
 _started = False
+_queue: "queue.Queue[Tuple[str, bool, Dict[str, Any]]]" = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+_WRITE_BACKOFF_MAX = 30.0
+
+def _signature_ok(raw: bytes, header: Optional[str]) -> bool:
+    # Без секрета проверить подпись нечем — отказываем, а не принимаем всё подряд
+    if not CALLBACK_HMAC_SECRET or not header or not header.startswith("sha256="):
+        return False
+    expected = hmac.new(CALLBACK_HMAC_SECRET.encode("utf-8"), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len("sha256="):])
+
+def _next_batch() -> List[Tuple[str, bool, Dict[str, Any]]]:
+    batch = [_queue.get()]
+    deadline = time.monotonic() + WEBHOOK_BATCH_WAIT
+    while len(batch) < WEBHOOK_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=timeout))
+        except queue.Empty:
+            break
+    return batch
+
+def _save(batch: List[Tuple[str, bool, Dict[str, Any]]]) -> None:
+    """Сохраняет пачку; sqlite3.OperationalError (база занята) пробрасывается для повтора.
 
-@_app.post("/callback")
-def callback():
+    Любая другая ошибка не исчезнет при повторе, поэтому пачка пишется по одному
+    колбэку, а сломанные записываются в лог и пропускаются.
+    """
     try:
-        data = request.get_json(force=True, silent=True) or {}
+        set_job_results(batch)
+        return
+    except sqlite3.OperationalError:
+        raise
+    except Exception:
+        log.exception("saving %d callback results failed, saving one by one", len(batch))
+    for item in batch:
+        try:
+            set_job_results([item])
+        except sqlite3.OperationalError:
+            raise
+        except Exception:
+            log.exception("dropping callback result for %s", item[0])
+
+def _write_forever() -> None:
+    while True:
+        batch = _next_batch()
+        # Relay уже получил 202 и повторять не будет — пока база занята, пачку не выбрасываем.
+        # Пока писатель ждёт, очередь заполняется и новые колбэки получают 503.
+        attempt = 0
+        while True:
+            try:
+                _save(batch)
+                break
+            except sqlite3.OperationalError:
+                attempt += 1
+                log.exception("saving %d callback results failed (attempt %d), retrying", len(batch), attempt)
+                time.sleep(min(0.5 * 2 ** (attempt - 1), _WRITE_BACKOFF_MAX))
+
+def _ensure_writer() -> None:
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        return
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_forever, name="callback-writer", daemon=True)
+            _writer.start()
+
+def create_app():
+    from flask import Flask, request, jsonify, send_from_directory
+    app = Flask("llm-callback-server")
+
+    @app.post("/callback")
+    def callback():
+        raw = request.get_data(cache=False)
+        if not _signature_ok(raw, request.headers.get("X-Signature")):
+            return jsonify({"ok": False, "error": "bad signature"}), 401
+        try:
+            data = json.loads(raw or b"{}")
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        # Тело relay: job_id, submission_id, ok, result; задание берётся из строки решения
         submission_id = data.get("submission_id")
-        task_id = data.get("task_id")
+        ok = data.get("ok", True) is not False
         result = data.get("result")
-        if not submission_id or not task_id or not isinstance(result, dict):
+        if not isinstance(submission_id, str) or not submission_id or (ok and not isinstance(result, dict)):
             return jsonify({"ok": False, "error": "bad payload"}), 400
-        set_job_result(submission_id, task_id, result)
-        return jsonify({"ok": True})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+        _ensure_writer()
+        try:
+            _queue.put((submission_id, ok, result if isinstance(result, dict) else {}), timeout=1.0)
+        except queue.Full:
+            resp = jsonify({"ok": False, "error": "busy"})
+            resp.headers["Retry-After"] = "1"
+            return resp, 503
+        return jsonify({"ok": True, "queued": True}), 202
+
+    @app.get("/uploads/<path:filename>")
+    def serve_upload(filename):
+        etag = upload_store.blob_etag(filename)
+        if etag is None:
+            # Старые файлы вида {task_id}_{ts}_{fname} — без кэширования
+            return send_from_directory(UPLOAD_DIR, filename, as_attachment=False, max_age=0)
+        # Имя = sha256 содержимого: сильный ETag, вечный кэш и Range (206) через conditional
+        resp = send_from_directory(UPLOAD_DIR, filename, as_attachment=False, conditional=True,
+                                   etag=etag, max_age=UPLOAD_CACHE_MAX_AGE)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
+
+    @app.get("/pages/<name>/<filename>")
+    def serve_page(name, filename):
+        # Страницы для LLM: каталог назван по sha256 файла, а имя страницы содержит DPI
+        etag = upload_store.blob_etag(name)
+        if etag is None or not filename.startswith("page_"):
+            return jsonify({"ok": False, "error": "not found"}), 404
+        resp = send_from_directory(os.path.dirname(page_pipeline.asset_path(name, filename)), filename,
+                                   as_attachment=False, conditional=True, etag=f"{etag}-{filename}",
+                                   max_age=UPLOAD_CACHE_MAX_AGE)
+        resp.cache_control.public = True
+        resp.cache_control.immutable = True
+        return resp
+
+    return app
+
+def get_app():
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+    return _app
 
-@_app.get("/uploads/<path:filename>")
-def serve_upload(filename):
-    return send_from_directory(UPLOAD_DIR, filename, as_attachment=False, max_age=0)
+def __getattr__(name: str):
+    # `services.webhook_server:app` для WSGI-серверов без импорта Flask при загрузке модуля
+    if name == "app":
+        return get_app()
+    raise AttributeError(name)
+
+def serve_forever(host: str = "0.0.0.0", port: int = WEBHOOK_PORT) -> None:
+    if not CALLBACK_HMAC_SECRET:
+        log.error("CALLBACK_HMAC_SECRET is not set: every /callback request will be rejected with 401. "
+                  "Set it to the relay's CALLBACK_HMAC_SECRET.")
+    _ensure_writer()
+    try:
+        from waitress import serve
+    except ImportError:
+        get_app().run(host=host, port=port, debug=False, use_reloader=False, threaded=True)
+        return
+    serve(get_app(), host=host, port=port, threads=WEBHOOK_THREADS, ident="llm-callback-server")
 
 def start_once() -> None:
     global _started
     if _started:
         return
-    def _run():
-        _app.run(host="0.0.0.0", port=WEBHOOK_PORT, debug=False, use_reloader=False)
-    threading.Thread(target=_run, daemon=True).start()
+    threading.Thread(target=serve_forever, daemon=True).start()
     _started = True
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve_forever()
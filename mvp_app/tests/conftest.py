@@ -0,0 +1,4 @@
+import os, sys
+
+# Модули приложения импортируются плоско (`from config import ...`), как при запуске из mvp_app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
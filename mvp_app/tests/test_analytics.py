@@ -0,0 +1,107 @@
+import random
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+
+import db
+from models import Task, Submission
+import repository
+from services import analytics
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "state.db"))
+    monkeypatch.setattr(db, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(db, "_migrated", False)
+    db.migrate()
+
+def _counts(*rows):
+    index = pd.MultiIndex.from_tuples([(f"T{i}", "c") for i in range(len(rows))], names=["task_id", "criterion"])
+    return pd.DataFrame(list(rows), columns=["n00", "n01", "n10", "n11"], index=index)
+
+def test_agreement_table_kappa():
+    # po = 0.7, ai_pass = 0.5, teacher_pass = 0.4, pe = 0.5 -> kappa = 0.4
+    row = analytics.agreement_table(_counts([20, 5, 10, 15])).iloc[0]
+    assert row["n"] == 50
+    assert row["agreement"] == pytest.approx(0.7)
+    assert row["ai_pass_rate"] == pytest.approx(0.5)
+    assert row["teacher_pass_rate"] == pytest.approx(0.4)
+    assert row["kappa"] == pytest.approx(0.4)
+
+def test_agreement_table_special_cases():
+    table = analytics.agreement_table(_counts([0, 0, 0, 5], [3, 0, 0, 0], [0, 0, 4, 0], [0, 0, 0, 0]))
+    # pe == 1: обе стороны всегда ставят одно и то же
+    assert table["kappa"].tolist()[:2] == [1.0, 1.0]
+    # AI всегда «выполнено», преподаватель всегда «нет»: pe = 0, согласия нет
+    assert table["agreement"].iloc[2] == 0.0
+    assert table["kappa"].iloc[2] == 0.0
+    # n == 0: доли и каппа не определены
+    assert table["n"].iloc[3] == 0
+    assert table[["agreement", "ai_pass_rate", "teacher_pass_rate", "kappa"]].iloc[3].isna().all()
+
+def _criteria(rnd, names):
+    return [{"name": name, "passed": rnd.random() < 0.6} for name in names]
+
+def _seed(rnd, tasks=3, students=15):
+    for t in range(tasks):
+        task_id = f"T{t:04d}"
+        repository.upsert_task(Task(task_id, "условие", t))
+        repository.create_submissions([
+            (Submission(f"{task_id}-{s}", task_id, str(s), None, "queued", "text", "x", None, None, 1), {})
+            for s in range(students)
+        ])
+
+def _snapshot():
+    return analytics.load_agreement(), analytics.load_score_deltas()
+
+def _assert_matches_rebuild():
+    agreement, deltas = _snapshot()
+    analytics.rebuild()
+    expected_agreement, expected_deltas = _snapshot()
+    pd.testing.assert_frame_equal(agreement.sort_index(), expected_agreement.sort_index(), check_dtype=False)
+    pd.testing.assert_frame_equal(deltas.sort_index(), expected_deltas.sort_index(), check_dtype=False)
+
+def test_incremental_updates_match_rebuild(database):
+    rnd = random.Random(7)
+    _seed(rnd)
+    names = ["a", "b", "c", "d"]
+    ids = [f"T{t:04d}-{s}" for t in range(3) for s in range(15)]
+
+    repository.set_job_results([(sid, True, {"criteria": _criteria(rnd, names)}) for sid in ids])
+    for sid in rnd.sample(ids, 30):
+        repository.upsert_teacher_review(sid, sid.split("-")[0], _criteria(rnd, names))
+    _assert_matches_rebuild()
+
+    # Повторная оценка AI, исправленная оценка преподавателя, переименованный критерий, ошибка LLM
+    repository.set_job_results([(sid, True, {"criteria": _criteria(rnd, names)}) for sid in rnd.sample(ids, 20)])
+    for sid in rnd.sample(ids, 20):
+        repository.upsert_teacher_review(sid, sid.split("-")[0], _criteria(rnd, ["a", "b", "x"]))
+    repository.set_job_results([(sid, False, {"error": "llm down"}) for sid in rnd.sample(ids, 5)])
+    _assert_matches_rebuild()
+
+def test_score_deltas(database):
+    _seed(random.Random(1), tasks=1, students=3)
+    ai = [{"name": "a", "passed": True}, {"name": "b", "passed": False}, {"name": "c", "passed": False}]
+    repository.set_job_results([(f"T0000-{s}", True, {"criteria": ai}) for s in range(3)])
+    # AI ставит 1; преподаватель 0, 2, 3 -> разница -1, 1, 2
+    for s, passed in enumerate([0, 2, 3]):
+        teacher = [{"name": n, "passed": i < passed} for i, n in enumerate("abc")]
+        repository.upsert_teacher_review(f"T0000-{s}", "T0000", teacher)
+    row = analytics.load_score_deltas().loc["T0000"]
+    assert row["n"] == 3
+    assert row["mean_delta"] == pytest.approx(np.mean([-1, 1, 2]))
+    assert row["mean_abs_delta"] == pytest.approx(np.mean([1, 1, 2]))
+    assert row["std_delta"] == pytest.approx(np.std([-1, 1, 2]))
+
+def test_failed_aggregate_update_rolls_back_review(database, monkeypatch):
+    _seed(random.Random(2), tasks=1, students=1)
+    repository.set_job_results([("T0000-0", True, {"criteria": [{"name": "a", "passed": True}]})])
+
+    def broken(conn, submission_ids):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(analytics, "record_reviews", broken)
+    with pytest.raises(RuntimeError):
+        repository.upsert_teacher_review("T0000-0", "T0000", [{"name": "a", "passed": False}])
+    assert repository.load_teacher_review("T0000-0") is None
@@ -0,0 +1,89 @@
+import os, random, time
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+from services import page_pipeline
+
+def _handwritten_page(lines: int, size=(1240, 1754), background=255):
+    """Страница A4 при 150 DPI с `lines` строками «почерка» ручкой толщиной 2px."""
+    img = Image.new("RGB", size, (background,) * 3)
+    draw = ImageDraw.Draw(img)
+    rnd = random.Random(lines)
+    for k in range(lines):
+        y = 150 + k * 38
+        draw.line([(100 + j * 12, y + rnd.randint(-6, 6)) for j in range(60)], fill=(30, 30, 80), width=2)
+    return img
+
+@pytest.mark.parametrize("lines", [1, 3, 10, 40])
+def test_sparse_handwriting_is_not_blank(lines):
+    assert not page_pipeline._is_blank(_handwritten_page(lines))
+
+def test_handwriting_on_grey_scan_is_not_blank():
+    assert not page_pipeline._is_blank(_handwritten_page(3, background=200))
+
+def test_empty_page_is_blank():
+    assert page_pipeline._is_blank(_handwritten_page(0))
+    assert page_pipeline._is_blank(_handwritten_page(0, background=200))
+
+def test_sparse_page_is_sent_to_llm(tmp_path):
+    src = tmp_path / "sparse.png"
+    _handwritten_page(3).save(src)
+    manifest = page_pipeline._render_assets(str(src), 150, None, str(tmp_path / "out"), "JPEG")["llm"]
+    assert [p["blank"] for p in manifest["pages"]] == [False]
+    assert (tmp_path / "out" / manifest["pages"][0]["image"]).exists()
+
+def test_all_blank_file_keeps_its_pages(tmp_path):
+    src = tmp_path / "blank.png"
+    _handwritten_page(0).save(src)
+    manifest = page_pipeline._render_assets(str(src), 150, None, str(tmp_path / "out"), "JPEG")["llm"]
+    assert manifest["pages"][0]["blank"]
+    assert page_pipeline.llm_file_refs("blank.png", manifest, "http://host") == [
+        {"url": f"http://host/pages/blank.png/{manifest['pages'][0]['image']}"}
+    ]
+
+def test_preview_dpi_change_keeps_llm_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(page_pipeline, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(page_pipeline, "PAGES_DIR", str(tmp_path / "pages"))
+    (tmp_path / "uploads").mkdir()
+    _handwritten_page(3).save(tmp_path / "uploads" / "sub.png")
+
+    manifest = page_pipeline.ensure("sub.png", timeout=30)
+    image = page_pipeline.asset_path("sub.png", manifest["pages"][0]["image"])
+    assert manifest["dpi"] == page_pipeline.PDF_DPI_DEFAULT
+    for dpi in (100, 200):
+        page_pipeline.schedule("sub.png", dpi)
+        while page_pipeline.thumbnails("sub.png") is None:
+            time.sleep(0.05)
+        assert os.path.exists(image)
+    assert page_pipeline.load_manifest("sub.png") == manifest
+
+def test_render_pool_is_recreated_after_worker_dies(tmp_path, monkeypatch):
+    import signal
+    monkeypatch.setattr(page_pipeline, "UPLOAD_DIR", str(tmp_path / "uploads"))
+    monkeypatch.setattr(page_pipeline, "PAGES_DIR", str(tmp_path / "pages"))
+    (tmp_path / "uploads").mkdir()
+    _handwritten_page(3).save(tmp_path / "uploads" / "first.png")
+    _handwritten_page(3).save(tmp_path / "uploads" / "second.png")
+
+    assert page_pipeline.ensure("first.png", timeout=30) is not None
+    pool = page_pipeline._get_pool()
+    for pid in list(pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    deadline = time.time() + 10
+    while not pool._broken and time.time() < deadline:
+        time.sleep(0.05)
+
+    assert page_pipeline.ensure("second.png", timeout=30) is not None
+    assert page_pipeline._get_pool() is not pool
+
+def test_preprocessing_error_falls_back_to_original_file(monkeypatch):
+    from services import dispatcher
+
+    def broken(name, timeout):
+        raise RuntimeError("corrupt file")
+
+    monkeypatch.setattr(page_pipeline, "ensure", broken)
+    payload = {"mode": "file", "file_url": "http://app/files/abc.pdf"}
+    assert dispatcher.slim_payload(payload)["file_refs"] == [{"url": "http://app/files/abc.pdf"}]
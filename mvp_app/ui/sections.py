@@ -1,16 +1,28 @@
 from __future__ import annotations
 import os, time
-from typing import Any, Dict, List, Optional
-import pandas as pd
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 import streamlit as st
-from models import Task, Submission, ReviewJob
+from models import Task, Submission
 from repository import (
-    upsert_task, delete_task, upsert_submission, upsert_teacher_review,
-    upsert_review_job, load_results
+    upsert_task, delete_task, upsert_teacher_review,
+    load_result, load_teacher_review, load_review_job, get_submission, make_submission_id,
+    count_submissions, submission_status_counts, list_submissions,
 )
-from services.llm_client import call_orchestrator_async
-from services.pdf_renderer import render_pdf_pages
-from config import PUBLIC_CALLBACK_BASE, UPLOAD_DIR
+from services import dispatcher, page_pipeline, upload_store
+from config import UPLOAD_DIR, SUBMISSIONS_PAGE_SIZE
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# pandas/numpy (и services.analytics) импортируются внутри функций: они нужны только
+# при открытом решении или аналитике и заметно удлиняют первый рендер страницы.
+
+STATUS_LABELS = {
+    "queued": "в очереди",
+    "processing": "на проверке",
+    "done": "проверено AI",
+    "error": "ошибка",
+}
 
 def toast(msg: str) -> None:
     st.toast(msg)
@@ -24,7 +36,6 @@ def add_task_ui():
             text = (st.session_state.get("new_task_text") or "").strip()
             t_id = f"T{st.session_state.task_counter:04d}"
             task = Task(id=t_id, condition=text, created=int(time.time()))
-            st.session_state.tasks.append(task.__dict__)
             st.session_state.task_counter += 1
             st.session_state.show_create = False
             st.session_state.pop("new_task_text", None)
@@ -40,9 +51,6 @@ def delete_confirmation_widget(tid: str):
         with c1:
             if st.button("Да, удалить", type="primary"):
                 delete_task(tid)
-                st.session_state.tasks = [t for t in st.session_state.tasks if t["id"] != tid]
-                st.session_state.results.pop(tid, None)
-                st.session_state.submissions.pop(tid, None)
                 st.session_state.confirm_delete_task = None
                 toast(f"Задание {tid} удалено")
                 st.rerun()
@@ -52,6 +60,7 @@ def delete_confirmation_widget(tid: str):
                 st.rerun()
 
 def criteria_df_block(title: str, rows: pd.DataFrame, key: str):
+    import pandas as pd
     rows = rows.copy()
     rows["passed"] = rows.get("passed", False).astype(bool)
     rows["name"] = rows.get("name", "").astype(str)
@@ -82,20 +91,155 @@ def criteria_df_block(title: str, rows: pd.DataFrame, key: str):
     )
     return int(rows["passed"].sum())
 
-def _build_file_on_disk(uploaded, task_id: str) -> Optional[str]:
+def _build_file_on_disk(uploaded, dpi: int) -> Optional[str]:
     try:
-        ts = int(time.time())
-        fname = uploaded.name
-        safe_name = f"{task_id}_{ts}_{fname}"
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        path = os.path.join(UPLOAD_DIR, safe_name)
-        with open(path, "wb") as out:
-            out.write(uploaded.getbuffer())
-        return safe_name
+        blob_name = upload_store.store(uploaded, uploaded.name)
     except Exception:
         return None
+    try:
+        page_pipeline.schedule(blob_name, dpi)
+    except Exception:
+        pass  # превью не критично для отправки
+    return blob_name
+
+def _saved_upload(uploaded, task_id: str, dpi: int) -> Optional[str]:
+    # Файл пишется на диск сразу при загрузке, чтобы рендер страниц шёл в фоне
+    key = f"saved_upload_{task_id}"
+    upload_id = getattr(uploaded, "file_id", None) or f"{uploaded.name}:{uploaded.size}"
+    saved = st.session_state.get(key)
+    if saved and saved[0] == upload_id:
+        page_pipeline.schedule(saved[1], dpi)
+        return saved[1]
+    if saved:
+        _forget_saved_upload(task_id)
+    saved_name = _build_file_on_disk(uploaded, dpi)
+    if saved_name:
+        st.session_state[key] = (upload_id, saved_name)
+    return saved_name
+
+def _forget_saved_upload(task_id: str) -> None:
+    # Сам файл не удаляется: те же байты может держать другая форма; неотправленные
+    # файлы удаляет upload_store.sweep_orphans
+    st.session_state.pop(f"saved_upload_{task_id}", None)
+
+def page_previews(saved_name: str) -> None:
+    thumbs = page_pipeline.thumbnails(saved_name)
+    if thumbs is None:
+        st.caption("Превью страниц готовится…")
+    elif thumbs:
+        st.image(thumbs, caption=[f"Стр. {i}" for i in range(1, len(thumbs) + 1)], width=160)
+
+def analytics_section():
+    from services import analytics
+    st.caption("Согласие AI и преподавателя по критериям (обновляется при каждой сохранённой оценке).")
+    agreement = analytics.load_agreement()
+    if agreement.empty:
+        st.info("Пока нет заданий, оценённых и AI, и преподавателем.")
+        return
+    st.dataframe(
+        agreement.reset_index()[["task_id", "criterion", "n", "agreement", "kappa",
+                                 "ai_pass_rate", "teacher_pass_rate"]],
+        hide_index=True,
+        column_config={
+            "task_id": st.column_config.TextColumn("Задание"),
+            "criterion": st.column_config.TextColumn("Критерий"),
+            "n": st.column_config.NumberColumn("Пар"),
+            "agreement": st.column_config.NumberColumn("Совпадение", format="%.2f"),
+            "kappa": st.column_config.NumberColumn("Каппа Коэна", format="%.2f"),
+            "ai_pass_rate": st.column_config.NumberColumn("AI: выполнено", format="%.2f"),
+            "teacher_pass_rate": st.column_config.NumberColumn("Преподаватель: выполнено", format="%.2f"),
+        },
+    )
+    st.dataframe(
+        analytics.load_score_deltas().reset_index(),
+        hide_index=True,
+        column_config={
+            "task_id": st.column_config.TextColumn("Задание"),
+            "n": st.column_config.NumberColumn("Решений"),
+            "mean_delta": st.column_config.NumberColumn("Δ (преп. − AI)", format="%.2f"),
+            "mean_abs_delta": st.column_config.NumberColumn("|Δ|", format="%.2f"),
+            "std_delta": st.column_config.NumberColumn("σ Δ", format="%.2f"),
+        },
+    )
+    st.caption("Выгрузка журнала оценок для Moodle: `python export.py gradebook --task T0001 --out grades.csv` "
+               "(или `--out grades.xlsx` — все задания, лист на задание)")
+
+def paginator(total: int, page_size: int, key: str) -> int:
+    """Номер страницы (с 1); виджет показывается, только если страниц больше одной."""
+    pages = max(1, -(-total // page_size))
+    if st.session_state.get(key, 1) > pages:
+        st.session_state[key] = pages
+    if pages == 1:
+        return 1
+    return int(st.number_input(f"Страница (из {pages})", min_value=1, max_value=pages, step=1, key=key))
+
+def _student_label(row: Dict[str, Any]) -> str:
+    who = row.get("student_name") or row.get("student_id") or "без имени"
+    return f"{who} — {STATUS_LABELS.get(row['status'], row['status'])}"
+
+def task_submissions_section(task: Dict[str, Any], dpi: int):
+    """Решения студентов по заданию: рисуется (и ходит в БД) только когда раздел раскрыт."""
+    tid = task["id"]
+    counts = submission_status_counts(tid)
+    total_all = sum(counts.values())
+    st.caption(f"Решений: {total_all}" + "".join(
+        f" · {STATUS_LABELS.get(k, k)}: {v}" for k, v in sorted(counts.items())
+    ))
+
+    c_filter, c_page = st.columns([0.5, 0.5])
+    with c_filter:
+        status = st.selectbox("Статус", [None, *STATUS_LABELS], key=f"status_filter_{tid}",
+                              format_func=lambda s: "все" if s is None else STATUS_LABELS[s])
+    with c_page:
+        page = paginator(count_submissions(tid, status), SUBMISSIONS_PAGE_SIZE, key=f"subs_page_{tid}")
+    rows = list_submissions(tid, SUBMISSIONS_PAGE_SIZE, (page - 1) * SUBMISSIONS_PAGE_SIZE, status)
+
+    select_key = f"selected_sub_{tid}"
+    pending = st.session_state.pop(f"select_next_{tid}", None)
+    options = [None] + [r["id"] for r in rows]
+    if pending in options:
+        st.session_state[select_key] = pending
+    elif st.session_state.get(select_key) not in options:
+        st.session_state.pop(select_key, None)
+    labels = {r["id"]: _student_label(r) for r in rows}
+    selected = st.selectbox("Решение", options, key=select_key,
+                            format_func=lambda sid: "➕ Новое решение" if sid is None else labels[sid])
+
+    if selected is None:
+        submission_form(task, dpi=dpi)
+        return
+    sub = get_submission(selected)
+    if sub is None:
+        st.info("Решение не найдено.")
+        return
+    submission_view(sub, dpi=dpi)
+    ai_and_teacher_blocks(task, sub.id)
+
+def submission_view(sub: Submission, dpi: int):
+    st.markdown(f"**Студент:** {sub.student_name or sub.student_id or '—'}")
+    if sub.mode == "text":
+        st.text_area("Отправленный текст", value=sub.text or "", height=180, disabled=True,
+                     key=f"sent_text_{sub.id}")
+    else:
+        st.caption("Отправленный файл:")
+        file_name = sub.file_name or "file"
+        file_path = sub.file_path
+        if file_path and os.path.exists(file_path):
+            blob_name = os.path.basename(file_path)
+            page_pipeline.schedule(blob_name, dpi)
+            page_previews(blob_name)
+            with open(file_path, "rb") as f:
+                st.download_button("Скачать", data=f.read(), file_name=file_name, key=f"download_{sub.id}")
+        else:
+            st.info(file_name)
 
 def submission_form(task: Dict[str, Any], dpi: int):
+    c_sid, c_name = st.columns([0.4, 0.6])
+    with c_sid:
+        student_id = st.text_input("ID студента", key=f"student_id_{task['id']}")
+    with c_name:
+        student_name = st.text_input("ФИО студента (необязательно)", key=f"student_name_{task['id']}")
+
     mode_key = f"input_mode_{task['id']}"
     st.session_state.setdefault(mode_key, "Файл")
     input_mode = st.radio("Способ загрузки решения", ["Файл", "Текст"], key=mode_key, horizontal=True)
@@ -103,34 +247,28 @@ def submission_form(task: Dict[str, Any], dpi: int):
     uploaded = None
     sol_text = ""
 
-    if st.session_state.submissions.get(task["id"]):
-        st.success("Решение отправлено. Ожидается результат от LLM.")
-        sub = st.session_state.submissions[task["id"]]
-        if sub["mode"] == "text":
-            st.text_area("Отправленный текст", value=sub.get("text") or "", height=180, disabled=True)
-        else:
-            st.caption("Отправленный файл:")
-            file_name = sub.get("file_name") or "file"
-            file_path = sub.get("file_path")
-            if file_path and os.path.exists(file_path):
-                with open(file_path, "rb") as f:
-                    st.download_button("Скачать", data=f.read(), file_name=file_name)
-            else:
-                st.info(file_name)
-        return
-
     if input_mode == "Файл":
         uploaded = st.file_uploader(f"Загрузите решение (PDF/изображение) для {task['id']}",
                                     type=["pdf", "png", "jpg", "jpeg"],
                                     key=f"file_{task['id']}")
-        if uploaded and uploaded.type == "application/pdf":
-            imgs = render_pdf_pages(uploaded.getvalue(), dpi=dpi)
-            if imgs:
-                st.image(imgs[0], caption="Превью 1-й страницы", use_container_width=True)
+        if uploaded:
+            saved_name = _saved_upload(uploaded, task["id"], dpi)
+            if saved_name:
+                page_previews(saved_name)
+        else:
+            _forget_saved_upload(task["id"])
     else:
         sol_text = st.text_area(f"Введите текст решения для {task['id']}", key=f"text_{task['id']}", height=180)
 
     if st.button("Отправить решение", key=f"send_{task['id']}"):
+        student_id = (student_id or "").strip()
+        if not student_id:
+            st.error("Укажите ID студента.")
+            st.stop()
+        submission_id = make_submission_id(task["id"], student_id)
+        if get_submission(submission_id):
+            st.error(f"Решение студента {student_id} по этому заданию уже есть.")
+            st.stop()
         if input_mode == "Файл" and not uploaded:
             st.error("Пожалуйста, загрузите файл.")
             st.stop()
@@ -138,81 +276,71 @@ def submission_form(task: Dict[str, Any], dpi: int):
             st.error("Пожалуйста, введите текст.")
             st.stop()
 
-        # Prepare payload (do NOT persist submission yet — to allow retry on failure)
-        file_url = None
-        tmp_saved_name = None
+        saved_name = None
         if input_mode == "Файл":
-            tmp_saved_name = _build_file_on_disk(uploaded, task["id"])
-            if not tmp_saved_name:
+            saved_name = _saved_upload(uploaded, task["id"], dpi)
+            if not saved_name:
                 st.error("Не удалось сохранить файл на сервере.")
                 st.stop()
-            file_url = f"{PUBLIC_CALLBACK_BASE.rstrip('/')}/uploads/{tmp_saved_name}"
-
-        payload = {
-            "submission_id": f"{task['id']}-submission",
-            "task_id": task["id"],
-            "task_text": task.get("condition", ""),
-            "mode": ("text" if input_mode == "Текст" else "file"),
-            "text": (sol_text or "") if input_mode == "Текст" else "",
-            "file_url": file_url,
-            "callback_url": f"{PUBLIC_CALLBACK_BASE.rstrip('/')}/callback",
-        }
-
-        ok, err = call_orchestrator_async(payload)
-        if not ok:
-            # On failure: keep the form enabled for retry and clean up temp file
-            if tmp_saved_name:
-                try:
-                    os.remove(os.path.join(UPLOAD_DIR, tmp_saved_name))
-                except Exception:
-                    pass
-            st.error(f"Не удалось связаться с LLM: {err}")
-            st.info("Попробуйте отправить ещё раз.")
-            st.stop()
 
-        # Success: now persist submission and create job so UI locks the form
+        # Submission, queued job and dispatch row are written in one transaction; the dispatcher sends it in the background
+        common = dict(id=submission_id, task_id=task["id"], student_id=student_id,
+                      student_name=(student_name or "").strip() or None, status="queued",
+                      uploaded_at=int(time.time()))
         if input_mode == "Текст":
-            sub = Submission(task_id=task["id"], mode="text", text=(sol_text or "").strip(),
-                             file_path=None, file_name=None, uploaded_at=int(time.time()))
+            sub = Submission(**common, mode="text", text=(sol_text or "").strip(),
+                             file_path=None, file_name=None)
         else:
-            abs_path = os.path.join(UPLOAD_DIR, tmp_saved_name)
-            sub = Submission(task_id=task["id"], mode="file", text=None, file_path=abs_path,
-                             file_name=uploaded.name, uploaded_at=int(time.time()))
-        upsert_submission(sub)
-        st.session_state.submissions[task["id"]] = sub.__dict__
-
-        submission_id = payload["submission_id"]
-        job = ReviewJob(submission_id, task["id"], "queued", None, None, int(time.time()), int(time.time()))
-        upsert_review_job(job)
-        st.session_state.review_jobs[submission_id] = job.__dict__
-
-        st.success("Решение отправлено на проверку. Ожидаем результат по webhook.")
+            sub = Submission(**common, mode="file", text=None, file_path=os.path.join(UPLOAD_DIR, saved_name),
+                             file_name=uploaded.name)
+        try:
+            created = dispatcher.submit(sub, dispatcher.build_payload(task, sub))
+        except FileNotFoundError:
+            # Файл формы пролежал неотправленным дольше UPLOAD_ORPHAN_MAX_AGE и уже удалён
+            _forget_saved_upload(task["id"])
+            st.error("Загруженный файл больше не доступен на сервере. Загрузите его ещё раз.")
+            st.stop()
+        if not created:
+            st.error(f"Решение студента {student_id} по этому заданию уже есть.")
+            st.stop()
+        st.session_state.pop(f"saved_upload_{task['id']}", None)
+
+        for k in (f"student_id_{task['id']}", f"student_name_{task['id']}", f"text_{task['id']}"):
+            st.session_state.pop(k, None)
+        # Widgets already rendered in this run: reset by dropping their keys, select the new submission next run
+        for k in (f"subs_page_{task['id']}", f"status_filter_{task['id']}"):
+            st.session_state.pop(k, None)
+        st.session_state[f"select_next_{task['id']}"] = submission_id
+        toast("Решение поставлено в очередь на проверку.")
         st.rerun()
 
-def ai_and_teacher_blocks(task: Dict[str, Any]):
-    submission_id = f"{task['id']}-submission"
-    job = st.session_state.review_jobs.get(submission_id)
-    if job and job["status"] in ("queued", "processing"):
+def ai_and_teacher_blocks(task: Dict[str, Any], submission_id: str):
+    import pandas as pd
+    job = load_review_job(submission_id)
+    if job and job["status"] == "queued":
+        st.info("Решение в очереди на отправку в LLM…")
+    elif job and job["status"] == "processing":
         st.info("Оценка запущена на внешнем LLM. Ожидаем результат по webhook…")
     elif job and job["status"] == "error":
-        st.error("Не удалось получить результат от LLM. Попробуйте ещё раз.")
+        st.error("Не удалось связаться с LLM.")
+        if st.button("Отправить повторно", key=f"retry_{submission_id}"):
+            dispatcher.retry(submission_id)
+            st.rerun()
 
-    # Refresh results inline
-    st.session_state.results = load_results()
-    data = st.session_state.results.get(task['id'])
+    data = load_result(submission_id)
     if not data:
         return
 
     if "criteria" in data and data["criteria"]:
         passed_count = criteria_df_block("Оценка AI:", pd.DataFrame(data["criteria"]),
-                                         key=f"df_ai_{task['id']}")
+                                         key=f"df_ai_{submission_id}")
         ai_total = min(int(passed_count), 10)
         st.metric("Итоговая оценка AI", f"{ai_total} / 10")
     else:
         st.info("Критерии отсутствуют.")
 
     st.subheader("Оценка преподавателя:")
-    teacher = st.session_state.teacher_reviews.get(task["id"])
+    teacher = load_teacher_review(submission_id)
     if data.get("criteria"):
         base = pd.DataFrame(data["criteria"])
         base["name"] = base.get("name", "").astype(str)
@@ -221,7 +349,7 @@ def ai_and_teacher_blocks(task: Dict[str, Any]):
         if teacher:
             traw = pd.DataFrame(teacher["criteria"])
             traw["passed"] = traw.get("passed", False).astype(bool)
-            criteria_df_block("Критерии преподавателя:", traw, key=f"df_teacher_{task['id']}")
+            criteria_df_block("Критерии преподавателя:", traw, key=f"df_teacher_{submission_id}")
             st.metric("Итоговая оценка преподавателя", f"{teacher['total']} / 10")
         else:
             st.caption("Отметьте статус и (опционально) добавьте пояснение к каждому критерию.")
@@ -232,20 +360,17 @@ def ai_and_teacher_blocks(task: Dict[str, Any]):
                 with c2: st.markdown(row["name"] or "")
                 with c3:
                     status_val = st.radio("Статус", ["Выполнено", "Не выполнено"],
-                                          horizontal=True, key=f"teach_radio_{task['id']}_{i}",
+                                          horizontal=True, key=f"teach_radio_{submission_id}_{i}",
                                           label_visibility="collapsed")
                 with c4:
                     note_val = st.text_input("Пояснение", value=row.get("details", "") or "",
-                                             key=f"teach_note_{task['id']}_{i}",
+                                             key=f"teach_note_{submission_id}_{i}",
                                              placeholder="Комментарий (необязательно)",
                                              label_visibility="collapsed")
                 teacher_inputs.append({"name": row["name"],
                                        "passed": (status_val == "Выполнено"),
                                        "details": (note_val or "").strip()})
-            if st.button("Сохранить оценку преподавателя", type="primary", key=f"save_teacher_{task['id']}"):
-                total = upsert_teacher_review(task["id"], teacher_inputs)
-                st.session_state.teacher_reviews[task["id"]] = {
-                    "criteria": teacher_inputs, "total": total, "updated": int(time.time())
-                }
+            if st.button("Сохранить оценку преподавателя", type="primary", key=f"save_teacher_{submission_id}"):
+                upsert_teacher_review(submission_id, task["id"], teacher_inputs)
                 st.success("Оценка преподавателя сохранена.")
                 st.rerun()